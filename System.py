@@ -13,8 +13,13 @@ and plotting of ray paths and positions
 import raytracer as ryt
 import opticalequipment as oe
 
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
 import scipy as sp
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from mpl_toolkits.mplot3d import Axes3D
 
 
@@ -27,8 +32,54 @@ def createOutput(z0):
     out = oe.OutputPlane(z0)
     return out
 
-def createBundle(number, spacing, point = True, xpos = 0, \
+beamcache = {} # Generator and parameters -> read-only beam arrays
+beamcachebytes = 32 * 10**6 # Most bytes of beams kept - about 660000 rays
+
+
+def cachedBytes():
+    # Total size in bytes of the beams held by the cache
+    return sum(array.nbytes for arrays in beamcache.values() \
+               for array in arrays)
+
+
+def cachedArrays(generator, *parameters, dtype = float):
+    # Returns the arrays made by generator(*parameters) as dtype, building
+    # them only the first time - later calls with the same parameters and
+    # dtype share them, so a single precision beam is never copied from a
+    # double precision one
+    # Beams bigger than beamcachebytes are not kept, so that their memory
+    # is given back as soon as the beam made from them is deleted
+    key = (generator.__name__, sp.dtype(dtype).str) + parameters
+    
+    if key in beamcache:
+        return beamcache[key]
+    
+    arrays = tuple(array.astype(dtype, copy = False) for array in \
+                   generator(*parameters))
+    
+    for array in arrays:
+        array.flags.writeable = False # Shared, so must not be changed
+    
+    size = sum(array.nbytes for array in arrays)
+    if size > beamcachebytes:
+        return arrays
+    
+    while beamcache and cachedBytes() + size > beamcachebytes:
+        del beamcache[next(iter(beamcache))] # Oldest is forgotten first
+        
+    beamcache[key] = arrays
+        
+    return arrays
+
+
+def clearBeamCache():
+    # Frees the memory held by every cached beam
+    beamcache.clear()
+
+
+def bundleArrays(number, spacing, point = True, xpos = 0, \
                  yangle = 0, zstart = -20):
+    # Positions and directions of the rays made by createBundle, as arrays
     
     if yangle >= sp.pi / 2:
         print ()
@@ -36,62 +87,96 @@ def createBundle(number, spacing, point = True, xpos = 0, \
         print ()
         raise Exception
     
-    rayarray = []
+    # Order of rays is 0, +1, -1, +2, -2 ... spacings from the axis
+    steps = sp.zeros(max(2 * number - 1, 0))
+    steps[1::2] = sp.arange(1, number)
+    steps[2::2] = -1 * sp.arange(1, number)
     
-    for y in range(number):
-        
-        if point: # A point source, radiating out
-            ydirection = spacing * y
+    positions = sp.zeros((len(steps), 3))
+    directions = sp.zeros((len(steps), 3))
+    
+    positions[:, 0] = xpos
+    positions[:, 2] = zstart
+    directions[:, 2] = 100
+    
+    if point: # A point source, radiating out
+        directions[:, 1] = spacing * steps
         
-            ray = ryt.Ray([xpos,0,zstart], [0,ydirection,100])
-            
-        elif not point: # collimated flat 'beam' - y-axis only
-            ydirection = 100 * sp.tan(yangle)
-            ypos = spacing * y
-            ystart = -1 * abs(zstart) * sp.tan(yangle)
-            
-            ray = ryt.Ray([xpos, ypos + ystart, zstart], [0, ydirection, 100])
-            
-        rayarray.append(ray)
+    elif not point: # collimated flat 'beam' - y-axis only
+        ystart = -1 * abs(zstart) * sp.tan(yangle)
         
+        positions[:, 1] = (spacing * steps) + ystart
+        directions[:, 1] = 100 * sp.tan(yangle)
         
-        if y != 0: # PRoduces a ray in the negative position/direction
-            if point:
-                ray = ryt.Ray([xpos,0,zstart], [0,-1 * ydirection,100])
-                
-            elif not point:
-                ystart = -1 * abs(zstart) * sp.tan(yangle)
-                ray = ryt.Ray([xpos, (-1 * ypos) + ystart, zstart], \
-                               [0, ydirection, 100])           
-            
-            rayarray.append(ray) # Holds all rays
+    return positions, directions
+
+
+def createBundle(number, spacing, point = True, xpos = 0, \
+                 yangle = 0, zstart = -20, asbundle = False, history = True, \
+                 dtype = float):
+    
+    positions, directions = cachedArrays(bundleArrays, number, spacing, \
+                                         point, xpos, yangle, zstart, \
+                                         dtype = dtype if asbundle else float)
+    
+    if asbundle: # Rays are kept together as arrays
+        return ryt.RayBundle(positions, directions, history = history, \
+                             dtype = dtype)
+    
+    rayarray = []
+    
+    for position, direction in zip(positions, directions):
+        rayarray.append(ryt.Ray(position, direction)) # Holds all rays
             
     return rayarray
 
 
 
-def createRecBeam(number, spacing, yangle):
-    # Beam that is square in cross-section
-    totray = []
+def recBeamArrays(number, spacing, yangle):
+    # Positions and directions of the rays made by createRecBeam, as arrays
+    allpositions = []
+    alldirections = []
+    
     for num in range(number):
         if num != 0:
             # Puts multiple flat bundles side-by-side
-            line1 = createBundle(number, spacing, False, num * spacing, yangle)
-            line2 = createBundle(number, spacing, False, \
-                                 -1 * num * spacing, yangle)
-            totray += line1 + line2
+            for xpos in [num * spacing, -1 * num * spacing]:
+                line = bundleArrays(number, spacing, False, xpos, yangle)
+                allpositions.append(line[0])
+                alldirections.append(line[1])
         elif num == 0:
-            line = createBundle(number, spacing, False, num, yangle)
-            totray += line
+            line = bundleArrays(number, spacing, False, num, yangle)
+            allpositions.append(line[0])
+            alldirections.append(line[1])
+            
+    if number == 0:
+        return sp.zeros((0, 3)), sp.zeros((0, 3))
+        
+    return sp.concatenate(allpositions), sp.concatenate(alldirections)
+
+
+def createRecBeam(number, spacing, yangle, asbundle = False, \
+                  history = True, dtype = float):
+    # Beam that is square in cross-section
+    positions, directions = cachedArrays(recBeamArrays, number, spacing, \
+                                         yangle, \
+                                         dtype = dtype if asbundle else float)
+    
+    if asbundle:
+        return ryt.RayBundle(positions, directions, history = history, \
+                             dtype = dtype)
+    
+    totray = []
+    for position, direction in zip(positions, directions):
+        totray.append(ryt.Ray(position, direction))
         
     return totray
     
         
-def createCylBeam(number, resolution = 0.1, xangle = 0, \
-                  yangle = 0, zstart = -20): 
-    # Familiar cylindrical beam
+def cylBeamArrays(number, resolution = 0.1, xangle = 0, \
+                  yangle = 0, zstart = -20):
+    # Positions and directions of the rays made by createCylBeam, as arrays
     
-    rayarray = []
     arclength = (sp.pi / 4) * resolution
     # Sets distance between points on the circle
     
@@ -101,18 +186,16 @@ def createCylBeam(number, resolution = 0.1, xangle = 0, \
     
     xstart = -1 * abs(zstart) * sp.tan(xangle) # Adjusts start point to
     ystart = -1 * abs(zstart) * sp.tan(yangle) # account for angle change
-
+    
+    xs = []
+    ys = []
+    
     for num in range(number):
         # Need to do r = 0 special case
         if num == 0:
-            
-            z = zstart # Single, central ray
-            x = xstart
-            y = ystart 
-        
-            ray = ryt.Ray([x, y, z], [xdirection, ydirection, zdirection])       
-            
-            rayarray.append(ray)
+            # Single, central ray
+            xs.append(sp.array([xstart]))
+            ys.append(sp.array([ystart]))
         
         else:
             
@@ -121,22 +204,158 @@ def createCylBeam(number, resolution = 0.1, xangle = 0, \
             points = int((2 * sp.pi) / (arclength / r)) 
             # number of points changes with r to give constant density
             
-            for point in range(points):
-                # Goes round 2 pi creating rays
-                theta = (arclength / r) * point
-                
-                z = zstart
-                x = r * sp.cos(theta) + xstart
-                y = r * sp.sin(theta) + ystart
-                
-                ray = ryt.Ray([x, y, z], [xdirection, ydirection, zdirection])
+            # Goes round 2 pi creating a ring of rays
+            theta = (arclength / r) * sp.arange(points)
             
-                rayarray.append(ray)
+            xs.append(r * sp.cos(theta) + xstart)
+            ys.append(r * sp.sin(theta) + ystart)
+            
+    total = sum(len(x) for x in xs)
+    positions = sp.empty((total, 3))
+    directions = sp.empty((total, 3))
+    
+    if total > 0:
+        positions[:, 0] = sp.concatenate(xs)
+        positions[:, 1] = sp.concatenate(ys)
+    positions[:, 2] = zstart
+    
+    directions[:] = [xdirection, ydirection, zdirection]
+    
+    return positions, directions
+    
+        
+def createCylBeam(number, resolution = 0.1, xangle = 0, \
+                  yangle = 0, zstart = -20, asbundle = False, \
+                  history = True, dtype = float): 
+    # Familiar cylindrical beam
+    # history = False keeps only the latest position of each ray in a bundle
+    # dtype = sp.float32 stores a bundle in single precision
+    positions, directions = cachedArrays(cylBeamArrays, number, resolution, \
+                                         xangle, yangle, zstart, \
+                                         dtype = dtype if asbundle else float)
+    
+    if asbundle: # Rays are kept together as arrays
+        return ryt.RayBundle(positions, directions, history = history, \
+                             dtype = dtype)
+    
+    rayarray = []
+    
+    for position, direction in zip(positions, directions):
+        rayarray.append(ryt.Ray(position, direction))
     
     return rayarray
 
-def propagateSystem(lenses, rays):
+def cylBeamChunks(chunksize, number, resolution = 0.1, xangle = 0, \
+                  yangle = 0, zstart = -20):
+    # Yields the rays of createCylBeam as (positions, directions) arrays of
+    # at most chunksize rays, without making the whole beam at once
+    arclength = (sp.pi / 4) * resolution
+    
+    zdirection = 100
+    xdirection = sp.tan(xangle) * zdirection
+    ydirection = sp.tan(yangle) * zdirection
+    
+    xstart = -1 * abs(zstart) * sp.tan(xangle)
+    ystart = -1 * abs(zstart) * sp.tan(yangle)
+    
+    # Index of the first ray of each ring
+    sizes = [int((2 * sp.pi) / (arclength / (num * resolution))) \
+             for num in range(1, number)]
+    firsts = sp.cumsum([0, 1] + sizes)[:number]
+    total = firsts[-1] + sizes[-1] if number > 1 else number
+    
+    for start in range(0, total, chunksize):
+        ids = sp.arange(start, min(start + chunksize, total))
+        
+        ring = sp.searchsorted(firsts, ids, side = 'right') - 1
+        point = ids - firsts[ring]
+        
+        positions = sp.empty((len(ids), 3))
+        directions = sp.empty((len(ids), 3))
+        
+        with sp.errstate(divide = 'ignore', invalid = 'ignore'):
+            r = ring * resolution
+            theta = (arclength / r) * point # Same steps as createCylBeam
+            
+            positions[:, 0] = sp.where(ring == 0, xstart, \
+                                       r * sp.cos(theta) + xstart)
+            positions[:, 1] = sp.where(ring == 0, ystart, \
+                                       r * sp.sin(theta) + ystart)
+        positions[:, 2] = zstart
+        
+        directions[:] = [xdirection, ydirection, zdirection]
+        
+        yield positions, directions
+        
+        
+def recBeamChunks(chunksize, number, spacing, yangle):
+    # Yields the rays of createRecBeam as (positions, directions) arrays,
+    # made a line of rays at a time, in chunks of at most chunksize rays
+    xpositions = [0]
+    for num in range(1, number):
+        xpositions += [num * spacing, -1 * num * spacing]
+    
+    perchunk = max(chunksize // max(2 * number - 1, 1), 1)
+    
+    for start in range(0, len(xpositions), perchunk):
+        lines = [bundleArrays(number, spacing, False, xpos, yangle) \
+                 for xpos in xpositions[start:start + perchunk]]
+        
+        yield sp.concatenate([line[0] for line in lines]), \
+              sp.concatenate([line[1] for line in lines])
+
+
+def cylBeamRings(number, resolution = 0.1):
+    # Ring index of every ray in createCylBeam's beam, in the same order
+    # A beam with fewer rings is the start of the beam with more rings
+    arclength = (sp.pi / 4) * resolution
+    
+    sizes = [1] # Single, central ray
+    
+    for num in range(1, number):
+        r = num * resolution
+        sizes.append(int((2 * sp.pi) / (arclength / r)))
+        
+    return sp.repeat(sp.arange(number), sizes[:number])
+
+
+def rmsByRings(lenses, number, resolution = 0.1, xangle = 0, \
+               yangle = 0, zstart = -20):
+    # RMS at the last lens for cylindrical beams of 1 to number rings
+    # Only the largest beam is traced - each smaller beam is a subset of it
+    beam = createCylBeam(number, resolution, xangle, yangle, zstart, \
+                         asbundle = True, history = False)
+    rings = cylBeamRings(number, resolution)
+    
+    propagateSystem(lenses, beam)
+    
+    ids, points = beam.hits(lenses[-1])
+    r2 = (points[:, 0] ** 2) + (points[:, 1] ** 2)
+    
+    # Totals for each ring, then for each beam by adding up the rings
+    ringtotals = sp.bincount(rings[ids], weights = r2, minlength = number)
+    ringcounts = sp.bincount(rings[ids], minlength = number)
+    
+    return sp.sqrt(sp.cumsum(ringtotals) / sp.cumsum(ringcounts))
+
+
+def propagateSystem(lenses, rays, threads = 1, chunksize = None):
     # LENSES MUST BE LIST OF LENS OBJECTS -- followed
+    # rays may be a list of Ray objects or a single RayBundle
+    # lenses may also be an OpticalSystem
+    # A RayBundle can be split into chunks of chunksize rays, traced by
+    # threads threads - see propagateThreaded
+    
+    if isinstance(rays, ryt.RayBundle) and threads > 1:
+        return propagateThreaded(lenses, rays, threads, chunksize)
+    
+    if isinstance(lenses, OpticalSystem):
+        if isinstance(rays, ryt.RayBundle):
+            return lenses.trace(rays)
+        lenses = lenses.getlenses()
+    
+    if isinstance(rays, ryt.RayBundle):
+        rays.reserve(len(lenses)) # Allocates the path record in one go
     
     for lens in lenses:
         lens.encounterlens(rays)
@@ -144,15 +363,737 @@ def propagateSystem(lenses, rays):
     return rays
 
 
-def plotyz(rayarray, lenses, title):
+def propagateThreaded(lenses, bundle, threads, chunksize = None):
+    # Traces a RayBundle in chunks on a pool of threads, then puts the
+    # chunks back together in ray order
+    # The array kernels (and the numba backend) release the GIL, so chunks
+    # run at the same time without copying them to other processes
+    # By default, there is one chunk for each thread
+    if chunksize is None:
+        chunksize = max(-1 * (-1 * len(bundle) // threads), 1)
+        
+    parts = [bundle.chunk(start, start + chunksize) for start in \
+             range(0, len(bundle), chunksize)]
+    
+    if len(parts) == 0:
+        return propagateSystem(lenses, bundle) # Nothing to split
+    
+    with ThreadPoolExecutor(threads) as pool:
+        # list waits for every chunk, and raises any exception
+        list(pool.map(lambda part: propagateSystem(lenses, part), parts))
+        
+    return bundle.join(parts)
+
+
+class OpticalSystem:
+    
+    """
+    A sequence of lenses, checked once when it is made, for tracing many 
+    beams through
+    The constants of each surface (z0, curvature, n1 / n2 and aperture) are
+    held in flat arrays, so trace does not look them up lens by lens
+    An OutputPlane may only be the last element
+    backend is 'numpy' or 'numba' (see opticalequipment.setBackend), or None
+    to use the default backend when tracing
+    Warning: Attributes should not be accessed directly outside of this class
+    """
+    
+    def __init__(self, lenses, backend = None):
+        self.__lenses = tuple(lenses)
+        self.__backend = backend
+        
+        if backend is not None:
+            oe.checkBackend(backend)
+        
+        if len(self.__lenses) == 0:
+            print ()
+            print ('An optical system needs at least one element')
+            print ()
+            raise Exception
+        
+        for index, lens in enumerate(self.__lenses):
+            if isinstance(lens, oe.OutputPlane):
+                if index != len(self.__lenses) - 1:
+                    print ()
+                    print ('Only the last element can be an output plane')
+                    print ()
+                    raise Exception
+                    
+            elif not isinstance(lens, oe.SphericalRefraction):
+                print ()
+                print ('{0} is not a lens or output plane'.format(lens))
+                print ()
+                raise Exception
+                
+            if index != 0 and lens.getz() < self.__lenses[index - 1].getz():
+                print ()
+                print ('Elements must be in order of increasing z')
+                print ()
+                raise Exception
+        
+        surfaces = [lens for lens in self.__lenses if not \
+                    isinstance(lens, oe.OutputPlane)]
+        
+        for before, after in zip(surfaces[:-1], surfaces[1:]):
+            if before.getn2() != after.getn1():
+                print ()
+                print ('Refractive index changes between {0} and {1}'\
+                       .format(before, after))
+                print ()
+                raise Exception
+        
+        self.__output = isinstance(self.__lenses[-1], oe.OutputPlane)
+        
+        # Constants of each surface, in order (the output plane only has z0)
+        self.__z0 = sp.array([lens.getz() for lens in self.__lenses], \
+                             dtype = float)
+        self.__curve = sp.array([lens.getcurve() for lens in surfaces], \
+                                dtype = float)
+        self.__ratio = sp.array([lens.getn1() / lens.getn2() for lens in \
+                                 surfaces], dtype = float)
+        self.__aprad = sp.array([lens.getaperture() for lens in surfaces], \
+                                dtype = float)
+        
+    def __repr__(self):
+        return "OpticalSystem([{0}])".format(', '.join(repr(lens) for \
+                                                       lens in self.__lenses))
+    
+    def __len__(self):
+        return len(self.__lenses)
+    
+    def getlenses(self):
+        return list(self.__lenses)
+    
+    def getbackend(self):
+        return self.__backend
+    
+    def getconstants(self):
+        # Arrays of z0 (for every element), and curvature, n1 / n2 and 
+        # aperture radius (for every refracting surface)
+        return self.__z0, self.__curve, self.__ratio, self.__aprad
+    
+    def trace(self, bundle):
+        # Propagates a RayBundle through every element of the system
+        bundle.reserve(len(self.__lenses))
+        
+        # Constants are converted to the bundle's precision once per trace
+        dtype = bundle.getdtype()
+        z0 = self.__z0.astype(dtype)
+        curve = self.__curve.astype(dtype)
+        ratio = self.__ratio.astype(dtype)
+        aprad = self.__aprad.astype(dtype)
+        
+        for index in range(len(self.__curve)):
+            oe.propagateSurface(bundle, self.__lenses[index], z0[index], \
+                                curve[index], ratio[index], aprad[index], \
+                                self.__backend)
+            
+        if self.__output:
+            oe.propagatePlane(bundle, self.__lenses[-1], z0[-1])
+            
+        return bundle
+
+
+def paraxialFocus(lenses):
+    # Paraxial estimate of the focal point of a system, from ray transfer
+    # (ABCD) matrices - any output planes in lenses are ignored
+    surfaces = [lens for lens in lenses if not isinstance(lens, \
+                                                          oe.OutputPlane)]
+    
+    # Height and angle of a collimated ray at the first surface
+    ray = sp.array([1.0, 0.0])
+    
+    for index, lens in enumerate(surfaces):
+        if index != 0: # Travels to this surface from the last one
+            gap = lens.getz() - surfaces[index - 1].getz()
+            ray = sp.array([[1, gap], [0, 1]]) @ ray
+        
+        n1 = lens.getn1()
+        n2 = lens.getn2()
+        refraction = sp.array([[1, 0], \
+                               [-1 * (n2 - n1) * lens.getcurve() / n2, \
+                                n1 / n2]])
+        ray = refraction @ ray
+        
+    if ray[1] == 0:
+        return sp.inf # Output is still collimated
+    
+    return surfaces[-1].getz() - (ray[0] / ray[1])
+
+
+def findFocus(lenses, beam):
+    # Finds the z where the RMS spot size of beam is smallest, and that RMS
+    # beam (a RayBundle) is traced once, up to the last refracting surface
+    # After that, rays are straight, so the total of x^2 + y^2 over the 
+    # rays is a quadratic in z, and its minimum is found directly
+    surfaces = [lens for lens in lenses if not isinstance(lens, \
+                                                          oe.OutputPlane)]
+    
+    propagateSystem(surfaces, beam)
+    
+    P = beam.getp()
+    K = beam.getk()
+    use = beam.getalive() & (K[:, 2] != 0)
+    
+    # Position in the xy plane is a + (b * z) for each ray
+    slope = K[use, :2] / K[use, 2][:, sp.newaxis]
+    offset = P[use, :2] - (slope * P[use, 2][:, sp.newaxis])
+    
+    z = -1 * sp.sum(offset * slope) / sp.sum(slope * slope)
+    
+    spot = offset + (slope * z)
+    rms = sp.sqrt(sp.sum(spot * spot) / sp.count_nonzero(use))
+    
+    return z, rms
+
+
+class SpotHistogram:
+    
+    """
+    A 2D grid counting the hits at an element in each xy bin
+    Hits can be added a chunk at a time, and drawing the grid takes the same
+    time however many rays have been added
+    extent is [[xmin, xmax], [ymin, ymax]] - if None, it is set from the
+    first hits added, and doubled whenever later hits fall outside it 
+    (bins is then rounded up to a multiple of 4)
+    Warning: Attributes should not be accessed directly outside of this class
+    """
+    
+    def __init__(self, extent = None, bins = 100):
+        self.__grow = extent is None
+        
+        if self.__grow:
+            bins = 4 * int(sp.ceil(bins / 4)) # So that bins can be merged
+            
+        self.__extent = extent
+        self.__bins = bins
+        self.__grid = sp.zeros((bins, bins)) # x along the first axis
+        
+    def __repr__(self):
+        return "SpotHistogram({0}, {1})".format(self.__extent, self.__bins)
+        
+    def add(self, points):
+        # Adds the hits at points (one row of x, y, ... per hit) to the grid
+        # Hits outside the extent are not counted
+        if self.__extent is None:
+            if len(points) == 0:
+                return self
+            edge = 1.5 * sp.amax(abs(points[:, :2]))
+            if edge == 0:
+                edge = 1e-3 # All hits on the axis
+            self.__extent = [[-1 * edge, edge], [-1 * edge, edge]]
+            
+        while self.__grow and len(points) > 0 and not self.covers(points):
+            self.double()
+            
+        (xmin, xmax), (ymin, ymax) = self.__extent
+        
+        x = sp.floor((points[:, 0] - xmin) * (self.__bins / (xmax - xmin)))
+        y = sp.floor((points[:, 1] - ymin) * (self.__bins / (ymax - ymin)))
+        
+        inside = (x >= 0) & (x < self.__bins) & (y >= 0) & (y < self.__bins)
+        
+        flat = (x[inside] * self.__bins + y[inside]).astype(int)
+        self.__grid += sp.bincount(flat, minlength = self.__bins ** 2)\
+                        .reshape(self.__bins, self.__bins)
+        
+        return self
+    
+    def addcounts(self, grid):
+        # Adds counts already binned on this histogram's grid, eg. saved
+        # from another histogram with the same extent and bins
+        self.__grid += grid
+        
+        return self
+    
+    def covers(self, points):
+        # True if every point is within the extent
+        (xmin, xmax), (ymin, ymax) = self.__extent
+        
+        return sp.amin(points[:, 0]) >= xmin and sp.amax(points[:, 0]) < xmax \
+           and sp.amin(points[:, 1]) >= ymin and sp.amax(points[:, 1]) < ymax
+    
+    def double(self):
+        # Doubles the extent about its centre, merging each 2x2 block of bins
+        half = self.__bins // 2
+        quarter = self.__bins // 4
+        
+        merged = self.__grid.reshape(half, 2, half, 2).sum(axis = (1, 3))
+        
+        self.__grid = sp.zeros((self.__bins, self.__bins))
+        self.__grid[quarter:quarter + half, quarter:quarter + half] = merged
+        
+        newextent = []
+        for low, high in self.__extent:
+            centre = (low + high) / 2
+            newextent.append([centre - (high - low), centre + (high - low)])
+        self.__extent = newextent
+        
+        return self
+    
+    def addhits(self, bundle, element):
+        # Adds the hits recorded at element by a traced RayBundle
+        return self.add(bundle.hits(element)[1])
+    
+    def getgrid(self):
+        # Counts in each bin and the extent they cover
+        return self.__grid, self.__extent
+    
+    def plot(self, title):
+        # Displays the grid as an image of the spot
+        (xmin, xmax), (ymin, ymax) = self.__extent
+        
+        plt.figure()
+        plt.title(title, fontsize = 20)
+        plt.xticks(fontsize = 15)
+        plt.yticks(fontsize = 15)
+        plt.xlabel('x (mm)', fontsize = 20)
+        plt.ylabel('y (mm)', fontsize = 20)
+        plt.imshow(self.__grid.T, origin = 'lower', cmap = 'Blues', \
+                   extent = [xmin, xmax, ymin, ymax], aspect = 'equal')
+        plt.colorbar(label = 'Rays per bin')
+        
+        plt.show()
+
+
+class BeamStatistics:
+    
+    """
+    Running totals for rays reaching an element, added to a chunk of rays
+    at a time, so that a beam never needs to be held in memory all at once
+    Keeps the sum of x^2 + y^2 for the RMS, a 2D histogram of hit 
+    positions, and counts of why rays were terminated
+    Without an extent, the histogram grows to fit the hits of every chunk,
+    so hits from outer rings in later chunks are still counted
+    Warning: Attributes should not be accessed directly outside of this class
+    """
+    
+    def __init__(self, bins = 100, extent = None):
+        self.__bins = bins
+        self.__histogram = SpotHistogram(extent, bins)
+        
+        self.__rays = 0
+        self.__hits = 0
+        self.__total = 0.0 # Sum of x^2 + y^2 over hits
+        self.__reasons = sp.zeros(4, dtype = int) # Counts for each reason
+        
+    def __repr__(self):
+        return "BeamStatistics({0}, {1})".format(self.__bins, \
+                                                 self.__histogram.getgrid()[1])
+    
+    def add(self, bundle, element):
+        # Adds the rays of a traced bundle that hit element to the totals
+        ids, points = bundle.hits(element)
+        
+        self.__rays += len(bundle)
+        self.__hits += len(ids)
+        self.__total += sp.sum((points[:, 0] ** 2) + (points[:, 1] ** 2), \
+                               dtype = float)
+        self.__reasons += sp.bincount(bundle.getreasons(), minlength = 4)
+        
+        self.__histogram.add(points)
+        
+        return self
+    
+    def getrms(self):
+        return sp.sqrt(self.__total / self.__hits)
+    
+    def getcounts(self):
+        # Number of rays, number of hits, and the number of rays terminated
+        # for each reason (indexed by raytracer.MISSED etc.)
+        return self.__rays, self.__hits, self.__reasons
+    
+    def gethistogram(self):
+        # The SpotHistogram of hit positions
+        return self.__histogram
+
+
+def streamSystem(lenses, chunks, bins = 100, extent = None, dtype = float):
+    # Traces a beam given in chunks (eg. by cylBeamChunks) through lenses, 
+    # keeping only running statistics at the last lens
+    # Memory use depends on the chunk size, not on the size of the beam
+    statistics = BeamStatistics(bins, extent)
+    
+    for positions, directions in chunks:
+        bundle = ryt.RayBundle(positions, directions, len(lenses), \
+                               history = False, dtype = dtype)
+        propagateSystem(lenses, bundle)
+        statistics.add(bundle, lenses[-1])
+        
+    return statistics
+
+
+class TraceCache:
+    
+    """
+    Remembers the state of a beam after each surface of the systems traced
+    A system that starts with the same surfaces as one traced before is 
+    only traced from the first surface that differs
+    Surfaces are matched by their parameters (ie. their repr)
+    Warning: the beam given should not be propagated itself, and is best 
+    created with history = False so that stored states are cheap
+    """
+    
+    def __init__(self, beam, maxsize = 256):
+        self.__beam = beam # Untraced RayBundle, copied for each system
+        self.__maxsize = maxsize
+        
+        # Tuple of surface reprs -> (surfaces, beam state after them)
+        self.__states = {}
+        
+    def __len__(self):
+        return len(self.__states)
+        
+    def propagate(self, lenses):
+        # Returns a new RayBundle that has passed through every lens
+        start = 0
+        bundle = None
+        
+        for end in range(len(lenses), 0, -1): # Longest known start first
+            key = tuple(repr(lens) for lens in lenses[:end])
+            
+            if key in self.__states:
+                elements, state = self.__states[key]
+                bundle = state.copy()
+                
+                # Hit records are kept against the lenses given here
+                for old, new in zip(elements, lenses):
+                    bundle.relabel(old, new)
+                
+                start = end
+                break
+        
+        if bundle is None:
+            bundle = self.__beam.copy()
+            
+        bundle.reserve(len(lenses) - start)
+        
+        for end in range(start + 1, len(lenses) + 1):
+            lenses[end - 1].propagate_bundle(bundle)
+            
+            if len(self.__states) >= self.__maxsize:
+                del self.__states[next(iter(self.__states))]
+                
+            key = tuple(repr(lens) for lens in lenses[:end])
+            self.__states[key] = (tuple(lenses[:end]), bundle.copy())
+            
+        return bundle
+
+
+def traceStack(positions, directions, z0, curve, ratio, aperture, outputz, \
+               decentre = None, maxrays = 10**4):
+    # Traces one beam (arrays of positions and directions, eg. from 
+    # cylBeamArrays) through S systems that have the same number of 
+    # refracting surfaces, followed by an output plane, but different 
+    # parameters - returns the RMS at the output plane of each system
+    # z0, curve, ratio (n1 / n2) and aperture are (S, surfaces) arrays, 
+    # outputz is (S,), and decentre (S, surfaces, 2) is the x and y offset
+    # of each surface from the axis
+    # Systems are traced together, as one stack of rays, in passes of 
+    # about maxrays rays - small passes stay in the CPU cache, and are 
+    # faster than large ones
+    z0 = sp.atleast_2d(z0)
+    systems = len(z0)
+    number = len(positions)
+    
+    if decentre is None:
+        decentre = sp.zeros(z0.shape + (2,))
+        
+    rms = sp.empty(systems)
+    step = max(maxrays // number, 1) # Systems in each pass
+    
+    for start in range(0, systems, step):
+        part = slice(start, start + step)
+        rms[part] = traceStackPass(positions, directions, z0[part], \
+                                   sp.atleast_2d(curve)[part], \
+                                   sp.atleast_2d(ratio)[part], \
+                                   sp.atleast_2d(aperture)[part], \
+                                   sp.asarray(outputz)[part], decentre[part])
+        
+    return rms
+
+
+def traceStackPass(positions, directions, z0, curve, ratio, aperture, \
+                   outputz, decentre):
+    # One pass of traceStack - the rays of every system are stacked as one
+    # (systems x rays, 3) array, and each parameter is repeated for the 
+    # rays of its system
+    systems = len(z0)
+    number = len(positions)
+    
+    P = sp.tile(positions, (systems, 1))
+    K = sp.tile(directions, (systems, 1))
+    alive = sp.ones(len(P), dtype = bool)
+    
+    # Directions are normalised once - refraction keeps them unit vectors, 
+    # and the normal c(point - centre) is already a unit vector on the 
+    # surface, so neither is normalised again at each surface
+    K /= sp.sqrt(sp.einsum('ij,ij->i', K, K))[:, sp.newaxis]
+    
+    with sp.errstate(divide = 'ignore', invalid = 'ignore'):
+        for index in range(z0.shape[1]):
+            
+            def perray(values):
+                return sp.repeat(values[:, index], number)
+            
+            # Decentred surfaces are met by shifting the rays instead
+            offset = sp.repeat(decentre[:, index], number, axis = 0)
+            local = P.copy()
+            local[:, :2] -= offset
+            
+            intersection, met = oe.sphereIntercept(local, K, \
+                                                   perray(z0), \
+                                                   perray(curve), \
+                                                   perray(aperture))
+            
+            nhat = oe.sphereNormal(intersection, perray(z0), perray(curve))
+            
+            k2hat, refracted = oe.snellRefract(K, nhat, perray(ratio))
+            
+            intersection[:, :2] += offset
+            
+            alive &= met & refracted
+            P = sp.where(alive[:, sp.newaxis], intersection, P)
+            K = sp.where(alive[:, sp.newaxis], k2hat, K)
+        
+        final, met = oe.planeIntercept(P, K, sp.repeat(outputz, number))
+    
+    hit = alive & met
+    system = sp.repeat(sp.arange(systems), number)[hit]
+    
+    r2 = (final[hit, 0] ** 2) + (final[hit, 1] ** 2)
+    total = sp.bincount(system, weights = r2, minlength = systems)
+    count = sp.bincount(system, minlength = systems)
+    
+    with sp.errstate(divide = 'ignore', invalid = 'ignore'):
+        return sp.sqrt(total / count)
+
+
+class SystemStack:
+    
+    """
+    S systems with the same number of refracting surfaces, followed by an
+    output plane, whose parameters differ - eg. the candidate lenses of an
+    optimisation, or perturbed copies of a design
+    Parameters are given as a list with one entry per surface, each entry
+    being a single value (shared by every system) or an (S,) array, and 
+    are held as (S, surfaces) arrays
+    rms traces one beam through every system at once (see traceStack)
+    Warning: Attributes should not be accessed directly outside of this class
+    """
+    
+    def __init__(self, z0, curve, n1, n2, aperture, outputz, \
+                 decentre = None):
+        if decentre is None:
+            decentre = [sp.zeros(2)] * len(z0)
+        
+        # Number of systems, from the longest parameter given
+        values = list(z0) + list(curve) + list(n1) + list(n2) + \
+                 list(aperture) + [outputz]
+        systems = max([sp.size(value) for value in values] + \
+                      [sp.size(offset) // 2 for offset in decentre])
+        
+        def stack(values):
+            return sp.stack([sp.broadcast_to(sp.asarray(value, \
+                             dtype = float), (systems,)) for value in \
+                             values], axis = 1)
+        
+        self.__z0 = stack(z0)
+        self.__curve = stack(curve)
+        self.__n1 = stack(n1)
+        self.__n2 = stack(n2)
+        self.__aprad = stack(aperture)
+        self.__outputz = sp.broadcast_to(sp.asarray(outputz, \
+                                         dtype = float), (systems,))
+        self.__decentre = sp.stack([sp.broadcast_to(sp.asarray(offset, \
+                                    dtype = float).reshape(-1, 2), \
+                                    (systems, 2)) for offset in decentre], \
+                                   axis = 1)
+        
+    def __repr__(self):
+        return "SystemStack({0} systems, {1} surfaces)".format( \
+                *self.__z0.shape)
+    
+    def __len__(self):
+        return len(self.__z0)
+    
+    def getz(self):
+        return self.__z0
+    
+    def getcurve(self):
+        return self.__curve
+    
+    def getn1(self):
+        return self.__n1
+    
+    def getn2(self):
+        return self.__n2
+    
+    def getaperture(self):
+        return self.__aprad
+    
+    def getoutput(self):
+        return self.__outputz
+    
+    def getdecentre(self):
+        return self.__decentre
+    
+    def lenses(self, index):
+        # The lenses of system index, as a list ending in its output plane
+        # Decentres cannot be represented, and are left out
+        lenses = [createLens(*parameters) for parameters in zip( \
+                  self.__z0[index], self.__curve[index], self.__n1[index], \
+                  self.__n2[index], self.__aprad[index])]
+        
+        return lenses + [createOutput(self.__outputz[index])]
+    
+    def rms(self, beam, maxrays = 10**4):
+        # RMS at the output plane of every system, for beam (an untraced 
+        # RayBundle) - nan for a system that no rays get through
+        return traceStack(beam.getp(), beam.getk(), self.__z0, \
+                          self.__curve, self.__n1 / self.__n2, \
+                          self.__aprad, self.__outputz, self.__decentre, \
+                          maxrays)
+
+
+def stackable(candidates):
+    # True if every list of lenses is refracting surfaces followed by an 
+    # output plane, with the same number of surfaces, so that they can be
+    # traced together by stackSystems
+    if len(candidates) == 0:
+        return False
+    
+    for lenses in candidates:
+        if len(lenses) != len(candidates[0]) or \
+           not isinstance(lenses[-1], oe.OutputPlane) or \
+           not all(isinstance(lens, oe.SphericalRefraction) for lens in \
+                   lenses[:-1]):
+            return False
+        
+    return True
+
+
+def stackSystems(candidates):
+    # SystemStack of several lists of lenses, each being refracting 
+    # surfaces followed by an output plane, with the same number of 
+    # surfaces
+    for lenses in candidates:
+        OpticalSystem(lenses) # Checks the order of the lenses
+        
+    if not stackable(candidates):
+        print ()
+        print ('Every system needs the same number of surfaces, and an'\
+               ' output plane')
+        print ()
+        raise Exception
+    
+    def parameter(getter):
+        # One (S,) array for each surface
+        return [sp.array([getter(lenses[index]) for lenses in candidates], \
+                         dtype = float) for index in \
+                range(len(candidates[0]) - 1)]
+    
+    return SystemStack(parameter(oe.SphericalRefraction.getz), \
+                       parameter(oe.SphericalRefraction.getcurve), \
+                       parameter(oe.SphericalRefraction.getn1), \
+                       parameter(oe.SphericalRefraction.getn2), \
+                       parameter(oe.SphericalRefraction.getaperture), \
+                       [lenses[-1].getz() for lenses in candidates])
+
+
+def lensParameters(lens):
+    # Dictionary of the parameters that make lens (as in createLens and
+    # createOutput), for saving
+    if isinstance(lens, oe.OutputPlane):
+        return {'type': 'OutputPlane', 'z0': lens.getz()}
+    
+    return {'type': 'SphericalRefraction', 'z0': lens.getz(), \
+            'curvature': lens.getcurve(), 'n1': lens.getn1(), \
+            'n2': lens.getn2(), 'apertureRadius': lens.getaperture()}
+
+
+def lensFromParameters(parameters):
+    # Makes the lens described by a dictionary from lensParameters
+    if parameters['type'] == 'OutputPlane':
+        return createOutput(parameters['z0'])
+    
+    return createLens(parameters['z0'], parameters['curvature'], \
+                      parameters['n1'], parameters['n2'], \
+                      parameters['apertureRadius'])
+
+
+def saveTrace(directory, bundle, lenses):
+    # Saves a traced RayBundle and the lenses (a list or OpticalSystem) it
+    # was traced through to directory, as .npy arrays and JSON
+    if isinstance(lenses, OpticalSystem):
+        lenses = lenses.getlenses()
+        
+    bundle.save(directory, lenses)
+    
+    with open(os.path.join(directory, 'lenses.json'), 'w') as file:
+        json.dump([lensParameters(lens) for lens in lenses], file, \
+                  indent = 1)
+        
+    return directory
+
+
+def loadTrace(directory, mmap_mode = 'r'):
+    # Reads back a trace written by saveTrace - returns the RayBundle and
+    # a list of new lenses, which its hits are recorded against
+    # Arrays are memory-mapped, so a large trace is not read into memory 
+    # until (and unless) it is used
+    with open(os.path.join(directory, 'lenses.json')) as file:
+        lenses = [lensFromParameters(parameters) for parameters in \
+                  json.load(file)]
+        
+    bundle = ryt.RayBundle.load(directory, lenses, mmap_mode)
+    
+    return bundle, lenses
+
+
+def sampleRays(count, maxrays = None, groups = None):
+    # Indices of at most about maxrays of count rays, for plotting
+    # groups (eg. from cylBeamRings) gives a label for each ray, and every
+    # group is then sampled in proportion to its size
+    if maxrays is None or count <= maxrays:
+        return sp.arange(count)
+    
+    if groups is None:
+        return sp.unique(sp.linspace(0, count - 1, maxrays).astype(int))
+    
+    chosen = []
+    
+    for group in sp.unique(groups):
+        members = sp.flatnonzero(groups == group)
+        take = max(int(round(len(members) * maxrays / count)), 1)
+        
+        # Evenly spread through the group, eg. around a ring
+        picks = sp.linspace(0, len(members) - 1, take).astype(int)
+        chosen.append(members[sp.unique(picks)])
+        
+    return sp.sort(sp.concatenate(chosen))
+
+
+def plotyz(rayarray, lenses, title, maxrays = None, groups = None):
     # plots rays' paths in yz plane
-    plottingarray = []
+    # All paths are drawn as one LineCollection - maxrays limits how many
+    # are drawn, choosing them with sampleRays (groups as used there)
+    chosen = sampleRays(len(rayarray), maxrays, groups)
+    outlined = rayarray # Rays the output plane is sized to
     
-    for ray in rayarray: # rayarray is a beam or bundle of rays
-        smallarray = []
-        for array in ray.vertices(): # Goes through list of past positions
-            smallarray.append([array[2], array[1]])
-        plottingarray.append(smallarray)
+    if isinstance(rayarray, ryt.RayBundle):
+        # One row of (z, y) vertices per ray
+        paths = rayarray.vertices()[chosen][:, :, [2, 1]]
+        
+        if len(chosen) < len(rayarray):
+            # Only the drawn rays are read, eg. from a memory-mapped trace
+            outlined = ryt.RayBundle(rayarray.getp()[chosen], \
+                                     rayarray.getk()[chosen], \
+                                     history = False, \
+                                     dtype = rayarray.getdtype())
+    else:
+        paths = [sp.array(rayarray[index].vertices(), dtype = float)\
+                 [:, [2, 1]] for index in chosen]
         
     plt.figure()
     plt.title(title, fontsize = 30)
@@ -163,30 +1104,46 @@ def plotyz(rayarray, lenses, title):
     plt.minorticks_on
     plt.grid()
     
-    for group in plottingarray:
-        
-        z = []
-        y = []
-        for points in group:
-            z.append(points[0])
-            y.append(points[1])
-        plt.plot(z, y, 'b')
+    plt.gca().add_collection(LineCollection(paths, colors = 'b'))
+    plt.gca().autoscale()
         
     for lens in lenses:
-        toplot = lens.plotlensyz(rayarray) # Plots lens outlines
+        toplot = lens.plotlensyz(outlined) # Plots lens outlines
         plt.plot(toplot[0], toplot[1], 'orange')
     
     plt.show()
         
     
-def plotspotxy(rayarray, title, z0 = 0):
+def plotspotxy(rayarray, title, z0 = 0, element = None, bins = None):
     # Plots ray locations in the xy plane
+    # For a RayBundle, element picks out the hits recorded at that element
+    # Giving bins draws a histogram image instead of a marker per ray
     plottingarray = []
     
-    for ray in rayarray:
-        for array in ray.vertices():
-            if array[2] == z0:
-                plottingarray.append([array[0], array[1]])
+    if isinstance(rayarray, ryt.RayBundle) and bins is not None:
+        histogram = SpotHistogram(bins = bins)
+        
+        if element is not None:
+            histogram.addhits(rayarray, element)
+        else:
+            points = rayarray.vertices().reshape(-1, 3)
+            histogram.add(points[points[:, 2] == z0])
+        
+        histogram.plot(title)
+        return histogram
+    
+    if isinstance(rayarray, ryt.RayBundle) and element is not None:
+        plottingarray = rayarray.hits(element)[1][:, :2].tolist()
+    
+    elif isinstance(rayarray, ryt.RayBundle):
+        points = rayarray.vertices().reshape(-1, 3)
+        plottingarray = points[points[:, 2] == z0, :2].tolist()
+    
+    else:
+        for ray in rayarray:
+            for array in ray.vertices():
+                if array[2] == z0:
+                    plottingarray.append([array[0], array[1]])
     
     if z0 == -20: # Corresponds to plane of instantiation
         plt.figure('2')
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+A module that times the ray tracing hot paths
+
+Each case is run for a range of ray counts (and surface counts where this
+matters), recording the best time, rays per second and peak memory.
+Results are written to a JSON file and can be compared against a stored
+baseline, failing if any case has slowed down by more than a threshold.
+
+Run as __main__, eg.
+    python benchmark.py --output bench.json --baseline baseline.json
+    python benchmark.py --output baseline.json --quick
+
+"""
+
+import System as sy
+import opticalequipment as oe
+import optimiser as op
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import scipy as sp
+
+
+RAYCOUNTS = [10**3, 10**4, 10**5, 10**6]
+SURFACECOUNTS = [2, 8]
+LISTLIMIT = 10**3 # Largest beam used for the one-Ray-per-object paths
+
+
+def beamRings(rays):
+    # Number of rings createCylBeam needs for about this many rays
+    # A beam of n rings holds 1 + 4n(n - 1) rays
+    return max(int(round(sp.sqrt(rays / 4))), 1)
+
+
+def beamArgs(rays):
+    # createCylBeam arguments for a beam of about this many rays, 10mm across
+    rings = beamRings(rays)
+    return rings, 5 / rings
+
+
+def testSystem(surfaces):
+    # Weak lenses with wide apertures, so that no rays are lost
+    lenses = []
+    for index in range(surfaces):
+        if index % 2 == 0:
+            lenses.append(sy.createLens(5 * index, 0.01, 1, 1.5168, 50))
+        else:
+            lenses.append(sy.createLens(5 * index, -0.01, 1.5168, 1, 50))
+
+    lenses.append(sy.createOutput(5 * surfaces + 100))
+
+    return lenses
+
+
+def timeCase(setup, run, repeats):
+    # Best time over repeats, then the peak memory of one more run
+    # setup is called before every run, and is not timed
+    best = sp.inf
+
+    for repeat in range(repeats):
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        best = min(best, time.perf_counter() - start)
+
+    args = setup()
+    tracemalloc.start()
+    run(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def cases(raycounts, surfacecounts):
+    # Yields (name, number of rays, setup, run) for every benchmark
+    for rays in raycounts:
+        rings, resolution = beamArgs(rays)
+        size = 1 + 4 * rings * (rings - 1)
+
+        def fresh():
+            sy.clearBeamCache()
+            return ()
+
+        yield ('createCylBeam/bundle rays={0}'.format(rays), size, fresh,
+               lambda rings = rings, resolution = resolution:
+               sy.createCylBeam(rings, resolution, asbundle = True))
+
+        if rays <= LISTLIMIT:
+            yield ('createCylBeam/list rays={0}'.format(rays), size, fresh,
+                   lambda rings = rings, resolution = resolution:
+                   sy.createCylBeam(rings, resolution))
+
+        def bundle(rings = rings, resolution = resolution):
+            return (sy.createCylBeam(rings, resolution, asbundle = True), )
+
+        def raylist(rings = rings, resolution = resolution):
+            return (sy.createCylBeam(rings, resolution), )
+
+        for surfaces in surfacecounts:
+            lenses = testSystem(surfaces)
+            label = 'rays={0} surfaces={1}'.format(rays, surfaces)
+
+            def traced(rings = rings, resolution = resolution,
+                       lenses = lenses):
+                beam = sy.createCylBeam(rings, resolution, asbundle = True)
+                return (sy.propagateSystem(lenses, beam), )
+
+            yield ('SphericalRefraction.propagate_bundle ' + label, size,
+                   bundle, lambda beam, lenses = lenses:
+                   sy.propagateSystem(lenses[:-1], beam))
+
+            system = sy.OpticalSystem(lenses)
+
+            yield ('OpticalSystem.trace ' + label, size, bundle,
+                   system.trace)
+
+            yield ('propagateSystem/threads=4 ' + label, size, bundle,
+                   lambda beam, system = system:
+                   sy.propagateSystem(system, beam, threads = 4))
+
+            if oe.numba is not None:
+                compiled = sy.OpticalSystem(lenses, 'numba')
+                # Compiles the kernel first, so it is not timed
+                compiled.trace(sy.createCylBeam(1, asbundle = True))
+
+                yield ('OpticalSystem.trace/numba ' + label, size, bundle,
+                       compiled.trace)
+
+            yield ('OpticalElement.rms/bundle ' + label, size, traced,
+                   lambda beam, lenses = lenses: lenses[-1].rms(beam))
+
+            if rays <= LISTLIMIT:
+                yield ('SphericalRefraction.encounterlens ' + label, size,
+                       raylist, lambda beam, lenses = lenses:
+                       sy.propagateSystem(lenses[:-1], beam))
+
+        output = sy.createOutput(100)
+
+        yield ('OutputPlane.propagate_bundle rays={0}'.format(rays), size,
+               bundle, output.propagate_bundle)
+
+        if rays <= LISTLIMIT:
+            def propagateEach(beam, output = output):
+                for ray in beam:
+                    output.propagate_ray(ray)
+
+            yield ('OutputPlane.propagate_ray rays={0}'.format(rays), size,
+                   raylist, propagateEach)
+
+    # The optimiser traces 15 candidate lenses with a 1201 ray beam
+    yield ('optimiser.optimum', 15 * 1201, lambda: (),
+           lambda: op.optimum(35.487, 1.5168, 10, quiet = True))
+
+
+def runBenchmarks(raycounts = RAYCOUNTS, surfacecounts = SURFACECOUNTS,
+                  repeats = 3):
+    results = {}
+
+    for name, rays, setup, run in cases(raycounts, surfacecounts):
+        seconds, peak = timeCase(setup, run, repeats)
+
+        results[name] = {'seconds': seconds,
+                         'rays_per_second': rays / seconds,
+                         'peak_mb': peak / 1e6}
+
+        print ('{0:60s} {1:12.0f} rays/s {2:10.1f} MB'.format(
+                name, rays / seconds, peak / 1e6))
+
+    return results
+
+
+def compare(results, baseline, threshold = 0.2):
+    # Returns the cases whose rays per second fell by more than threshold
+    # (as a fraction) compared to baseline
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        old = baseline[name]['rays_per_second']
+        new = result['rays_per_second']
+
+        if new < old * (1 - threshold):
+            regressions.append((name, old, new))
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[1])
+    parser.add_argument('--output', default = 'bench.json',
+                        help = 'JSON file to write the results to')
+    parser.add_argument('--baseline',
+                        help = 'JSON file of earlier results to compare to')
+    parser.add_argument('--threshold', type = float, default = 0.2,
+                        help = 'fractional slowdown counted as a regression')
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--quick', action = 'store_true',
+                        help = 'only use up to 10^4 rays')
+    args = parser.parse_args()
+
+    raycounts = RAYCOUNTS[:2] if args.quick else RAYCOUNTS
+
+    results = runBenchmarks(raycounts, SURFACECOUNTS, args.repeats)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent = 1, sort_keys = True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        regressions = compare(results, baseline, args.threshold)
+
+        for name, old, new in regressions:
+            print ('REGRESSION {0}: {1:.0f} -> {2:.0f} rays/s'.format(
+                    name, old, new))
+
+        if regressions:
+            sys.exit(1)
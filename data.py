@@ -30,13 +30,10 @@ def task15(lenses, beamarray):
 
 def rmsresults(maxraynumber, resolution, lenses):
     # carries out task 15 for a range of beam diameters
+    # The widest beam is traced once, and contains all of the smaller beams
     raynumbers = sp.arange(1, maxraynumber + 1, 1)
-    beams = []
-
-    for number in raynumbers:
-        beams.append(sy.createCylBeam(number, resolution, 0, 0, -20))
-        
-    result = task15(lenses, beams)
+    
+    result = list(sy.rmsByRings(lenses, maxraynumber, resolution, 0, 0, -20))
     
     return raynumbers, result
 
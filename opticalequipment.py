@@ -7,8 +7,413 @@ Created on Tue Feb 18 16:33:19 2020
 A module that handles the properties and behaviours of the lenses
 """
 
+import raytracer as ryt
+
+import math
+
 import scipy as sp
 
+try:
+    import numba # Optional, for the compiled backend
+except ImportError:
+    numba = None
+
+
+# Batch kernels, shared by the elements' _bundle methods and by
+# System.OpticalSystem, which passes in constants it has computed once
+# Parameters should already be in the precision of the bundle, and may be
+# a single value or one value per ray (as in System.traceStack)
+
+COMPACTFRACTION = 0.9 # Below this fraction of live rays, only they are traced
+
+BACKENDS = ['numpy', 'numba']
+backend = 'numpy' # Used by propagateSurface unless another is given
+
+
+def setBackend(name):
+    # Chooses how surfaces are traced by default - 'numpy' uses the array 
+    # kernels below, 'numba' compiles one loop over the rays (see
+    # fusedSurface), and needs numba to be installed
+    global backend
+    
+    backend = checkBackend(name)
+    
+    return backend
+
+
+def checkBackend(name):
+    # Raises an exception unless name is a backend that can be used
+    if name not in BACKENDS:
+        print ()
+        print ('Backend must be one of {0}'.format(BACKENDS))
+        print ()
+        raise Exception
+        
+    if name == 'numba' and numba is None:
+        print ()
+        print ('The numba backend needs numba to be installed')
+        print ()
+        raise Exception
+    
+    return name
+
+
+def column(value):
+    # A parameter shaped to multiply rows of vectors, whether it is a single
+    # value or one value per row
+    return sp.asarray(value)[..., sp.newaxis]
+
+
+def sphereIntercept(P, K, z0, curve, aperture):
+    # Intersection of rays (rows of P and K) with a spherical surface, and
+    # a mask that is False where a ray misses it
+    # The surface is written as c|x - z0|^2 - 2(z - z0) = 0, which stays
+    # well behaved as the curvature c goes to 0 (a plane)
+    
+    # Relative to the vertex of the lens
+    local = P.copy()
+    local[:, 2] -= z0
+    
+    # Quadratic a.lam^2 + 2b.lam + c = 0 for every ray at once
+    a = curve * sp.einsum('ij,ij->i', K, K)
+    b = (curve * sp.einsum('ij,ij->i', K, local)) - K[:, 2]
+    c = (curve * sp.einsum('ij,ij->i', local, local)) - (2 * local[:, 2])
+    
+    discriminant = (b * b) - (a * c)
+    
+    # A negative discriminant means no intercept
+    intersection = discriminant >= 0
+    
+    with sp.errstate(divide = 'ignore', invalid = 'ignore'):
+        # Stable form of the roots, avoiding cancellation between b and
+        # the square root - q is never small unless both roots are
+        q = -1 * (b + sp.copysign(sp.sqrt(sp.where(intersection, \
+                                                   discriminant, 0)), b))
+        lamNear = c / q
+        lamFar = q / a # Goes to infinity as the lens becomes flat
+        
+        # Correct intercept is on the same side of the centre as the 
+        # vertex, ie. where c(z - z0) < 1, for both convex and concave
+        nearside = curve * (local[:, 2] + (lamNear * K[:, 2])) < 1
+        lam = sp.where(nearside, lamNear, lamFar)
+        
+        final = P + (K * lam[:, sp.newaxis])
+        
+        # Rays parallel to a flat surface never meet it
+        intersection &= sp.isfinite(lam)
+        
+        # Handles constraints on the size of lens
+        intersection &= (abs(final[:, 0]) <= aperture) & \
+                        (abs(final[:, 1]) <= aperture)
+    
+    return final, intersection
+
+
+def sphereNormal(points, z0, curve):
+    # Normal of a spherical surface at each row of points
+    # This is c(point - centre), which has unit length on the surface 
+    # and is continuous as the curvature goes to 0
+    normal = points.copy()
+    normal[:, 2] -= z0 # Relative to the vertex
+    normal *= column(curve)
+    normal[:, 2] -= 1
+    
+    return normal
+
+
+def snellRefract(khat, nhat, ratio):
+    # Refracts unit directions at unit normals, ratio being n1 / n2
+    # Returns new directions and a mask that is False where total 
+    # internal reflection is observed
+    cosine = sp.einsum('ij,ij->i', khat, nhat)
+    
+    # Vector form of Snell's law, with |n x k|^2 = 1 - (k.n)^2
+    alongnormal2 = 1 - ((ratio ** 2) * (1 - (cosine ** 2)))
+    
+    refracted = alongnormal2 >= 0
+    
+    alongsurface = column(ratio) * (khat - (nhat * cosine[:, sp.newaxis]))
+    alongnormal = sp.sqrt(sp.where(refracted, alongnormal2, 0))
+    
+    k2hat = alongsurface - (nhat * alongnormal[:, sp.newaxis])
+    
+    return k2hat, refracted
+
+
+def planeIntercept(P, K, z0):
+    # Intersection of rays with the plane z = z0, and a mask that is False
+    # for rays parallel to it, which never meet it
+    intersection = K[:, 2] != 0
+    
+    with sp.errstate(divide = 'ignore', invalid = 'ignore'):
+        mu = (z0 - P[:, 2]) / K[:, 2]
+        final = P + (K * mu[:, sp.newaxis])
+        
+    return final, intersection
+
+
+def liveIds(bundle):
+    # The rays of bundle that an element needs to act on
+    # Usually the ids of the live rays, but a slice of every ray while 
+    # nearly all are live, as then picking them out costs more than it saves
+    live = bundle.getlive()
+    
+    if len(live) >= COMPACTFRACTION * len(bundle):
+        return slice(None)
+    
+    return live
+
+
+def scatter(full, ids, values):
+    # full with its rows at ids (along the last but one axis) replaced by
+    # values - full itself is not changed
+    if isinstance(ids, slice):
+        return values
+    
+    new = full.copy()
+    new[..., ids, :] = values
+    
+    return new
+
+
+def fullMask(ids, mask, size):
+    # Mask over all size rays that is True for the ids where mask is
+    if isinstance(ids, slice):
+        return mask
+    
+    full = sp.zeros(size, dtype = bool)
+    full[ids[mask]] = True
+    
+    return full
+
+
+def fusedSurface(P, K, alive, z0, curve, ratio, aperture, newP, newK, \
+                 status):
+    # One pass over the rays doing the work of sphereIntercept, sphereNormal 
+    # and snellRefract, with no temporary arrays - compiled when numba is 
+    # installed (and very slow if not)
+    # Fills in newP, newK, and the status of each ray - PROPAGATING if it 
+    # passed through, MISSED or REFLECTED, or -1 if it was already dead
+    for i in range(P.shape[0]):
+        newP[i, 0] = P[i, 0]
+        newP[i, 1] = P[i, 1]
+        newP[i, 2] = P[i, 2]
+        newK[i, 0] = K[i, 0]
+        newK[i, 1] = K[i, 1]
+        newK[i, 2] = K[i, 2]
+        
+        if not alive[i]:
+            status[i] = -1
+            continue
+        
+        kx = K[i, 0]
+        ky = K[i, 1]
+        kz = K[i, 2]
+        
+        # Relative to the vertex of the lens
+        lx = P[i, 0]
+        ly = P[i, 1]
+        lz = P[i, 2] - z0
+        
+        a = curve * ((kx * kx) + (ky * ky) + (kz * kz))
+        b = (curve * ((kx * lx) + (ky * ly) + (kz * lz))) - kz
+        c = (curve * ((lx * lx) + (ly * ly) + (lz * lz))) - (2 * lz)
+        
+        discriminant = (b * b) - (a * c)
+        
+        status[i] = ryt.MISSED
+        
+        if discriminant >= 0:
+            q = -1 * (b + math.copysign(math.sqrt(discriminant), b))
+            lam = c / q
+            
+            if not curve * (lz + (lam * kz)) < 1:
+                lam = q / a
+                
+            x = P[i, 0] + (kx * lam)
+            y = P[i, 1] + (ky * lam)
+            z = P[i, 2] + (kz * lam)
+            
+            if math.isfinite(lam) and abs(x) <= aperture and \
+               abs(y) <= aperture:
+                # Unit normal and direction
+                nx = curve * x
+                ny = curve * y
+                nz = (curve * (z - z0)) - 1
+                length = math.sqrt((nx * nx) + (ny * ny) + (nz * nz))
+                nx /= length
+                ny /= length
+                nz /= length
+                
+                length = math.sqrt((kx * kx) + (ky * ky) + (kz * kz))
+                kx /= length
+                ky /= length
+                kz /= length
+                
+                cosine = (kx * nx) + (ky * ny) + (kz * nz)
+                alongnormal2 = 1 - ((ratio ** 2) * (1 - (cosine ** 2)))
+                
+                status[i] = ryt.REFLECTED
+                
+                if alongnormal2 >= 0:
+                    alongnormal = math.sqrt(alongnormal2)
+                    
+                    newP[i, 0] = x
+                    newP[i, 1] = y
+                    newP[i, 2] = z
+                    newK[i, 0] = (ratio * (kx - (nx * cosine))) - \
+                                 (nx * alongnormal)
+                    newK[i, 1] = (ratio * (ky - (ny * cosine))) - \
+                                 (ny * alongnormal)
+                    newK[i, 2] = (ratio * (kz - (nz * cosine))) - \
+                                 (nz * alongnormal)
+                    status[i] = ryt.PROPAGATING
+                    
+        if status[i] != ryt.PROPAGATING and K[i, 2] != 0:
+            # Rays that are terminated here stop at the plane of the lens
+            mu = (z0 - P[i, 2]) / K[i, 2]
+            newP[i, 0] = P[i, 0] + (K[i, 0] * mu)
+            newP[i, 1] = P[i, 1] + (K[i, 1] * mu)
+            newP[i, 2] = P[i, 2] + (K[i, 2] * mu)
+
+
+if numba is not None:
+    # Division by zero gives inf or nan, as in numpy, rather than raising
+    # The GIL is released, so that chunks can be traced in threads
+    fusedSurface = numba.njit(error_model = 'numpy', nogil = True)\
+                   (fusedSurface)
+
+
+def propagateSurface(bundle, surface, z0, curve, ratio, aperture, \
+                     using = None):
+    # Passes every ray in bundle through surface (a SphericalRefraction),
+    # whose parameters are given
+    # using chooses the backend, the default being the module's backend
+    # Only the live rays are worked on (see liveIds) - terminated rays 
+    # keep their position
+    if using is None:
+        using = backend
+        
+    if using == 'numba' and bundle.getdp() is None:
+        # Derivatives are only worked out by the numpy kernels
+        P = bundle.getp()
+        K = bundle.getk()
+        newP = sp.empty_like(P)
+        newK = sp.empty_like(K)
+        status = sp.empty(len(P), dtype = sp.int8)
+        
+        fusedSurface(P, K, bundle.getalive(), z0, curve, ratio, aperture, \
+                     newP, newK, status)
+        
+        bundle.append(newP, newK)
+        bundle.record(surface, sp.flatnonzero(status == ryt.PROPAGATING))
+        bundle.stop(status == ryt.MISSED, ryt.MISSED)
+        bundle.stop(status == ryt.REFLECTED, ryt.REFLECTED)
+        
+        return bundle
+    
+    ids = liveIds(bundle)
+    
+    P = bundle.getp()[ids]
+    K = bundle.getk()[ids]
+    alive = bundle.getalive()[ids]
+    
+    with sp.errstate(divide = 'ignore', invalid = 'ignore'):
+        # Rays that are terminated here stop at the plane of the lens
+        termPoint = P + K * ((z0 - P[:, 2]) / K[:, 2])[:, sp.newaxis]
+        # A ray with no z-direction stays where it is
+        termPoint[K[:, 2] == 0] = P[K[:, 2] == 0]
+    
+        intersection, met = sphereIntercept(P, K, z0, curve, aperture)
+        
+        surfaceNormal = sphereNormal(intersection, z0, curve)
+        
+        # NORMALISE BOTH DIRECTION AND NORMAL HERE
+        k1norm = K / sp.sqrt(sp.einsum('ij,ij->i', K, K))[:, sp.newaxis]
+        nnorm = surfaceNormal / sp.sqrt(sp.einsum('ij,ij->i', \
+                        surfaceNormal, surfaceNormal))[:, sp.newaxis]
+        
+        k2norm, refracted = snellRefract(k1norm, nnorm, ratio)
+    
+    passed = alive & met & refracted
+    # If ray does not meet optical element or total internal reflection 
+    # is observed
+    stopped = alive & ~passed
+    
+    newP = sp.where(passed[:, sp.newaxis], intersection, P)
+    newP = sp.where(stopped[:, sp.newaxis], termPoint, newP)
+    newK = sp.where(passed[:, sp.newaxis], k2norm, K)
+    
+    newdP = None
+    newdK = None
+    
+    if bundle.getdp() is not None:
+        with sp.errstate(divide = 'ignore', invalid = 'ignore'):
+            newdP, newdK = surface.derivatives_bundle(bundle, intersection, \
+                                                      k1norm, nnorm, ids)
+        # Only rays that carry on have meaningful derivatives
+        newdP = sp.where(passed[:, sp.newaxis], newdP, 0)
+        newdK = sp.where(passed[:, sp.newaxis], newdK, 0)
+        
+        # Terminated rays have no derivatives
+        newdP = scatter(sp.zeros_like(bundle.getdp()), ids, newdP)
+        newdK = scatter(sp.zeros_like(bundle.getdk()), ids, newdK)
+    
+    size = len(bundle)
+    
+    bundle.append(scatter(bundle.getp(), ids, newP), \
+                  scatter(bundle.getk(), ids, newK), newdP, newdK)
+    bundle.record(surface, sp.flatnonzero(fullMask(ids, passed, size)))
+    bundle.stop(fullMask(ids, alive & ~met, size), ryt.MISSED)
+    bundle.stop(fullMask(ids, alive & met & ~refracted, size), \
+                ryt.REFLECTED)
+    
+    return bundle
+
+
+def propagatePlane(bundle, plane, z0):
+    # Passes every ray in bundle onto plane (an OutputPlane) at z0
+    # As for propagateSurface, only the live rays are worked on
+    ids = liveIds(bundle)
+    
+    P = bundle.getp()[ids]
+    K = bundle.getk()[ids]
+    alive = bundle.getalive()[ids]
+    
+    intersection, met = planeIntercept(P, K, z0)
+    
+    passed = alive & met
+    
+    newP = sp.where(passed[:, sp.newaxis], intersection, P)
+    
+    newdP = None
+    
+    if bundle.getdp() is not None:
+        # Derivative of the plane intercept, including moving the plane
+        dP = bundle.getdp()[:, ids]
+        dK = bundle.getdk()[:, ids]
+        dz0 = bundle.seed(plane, 'z0')[:, sp.newaxis]
+        
+        with sp.errstate(divide = 'ignore', invalid = 'ignore'):
+            mu = (z0 - P[:, 2]) / K[:, 2]
+            dmu = (dz0 - dP[:, :, 2] - (mu * dK[:, :, 2])) / K[:, 2]
+            newdP = dP + (dK * mu[:, sp.newaxis]) + \
+                    (K * dmu[:, :, sp.newaxis])
+            
+        newdP = sp.where(passed[:, sp.newaxis], newdP, 0)
+        newdP = scatter(sp.zeros_like(bundle.getdp()), ids, newdP)
+    
+    size = len(bundle)
+    
+    bundle.append(scatter(bundle.getp(), ids, newP), None, newdP)
+    bundle.record(plane, sp.flatnonzero(fullMask(ids, passed, size)))
+    # Rays ALWAYS terminate
+    bundle.stop(fullMask(ids, passed, size), ryt.ABSORBED)
+    bundle.stop(fullMask(ids, alive & ~met, size), ryt.MISSED)
+    
+    return bundle
+
+
 class OpticalElement:
     
     """
@@ -25,30 +430,66 @@ class OpticalElement:
         
         raise NotImplementedError()
         
+    def propagate_bundle(self, bundle):
+        ##propagate a whole RayBundle through the optical element
+        
+        raise NotImplementedError()
+        
     def encounterlens(self, rayarray):
         # General handling of multiple rays (ie. a beam) 
         # - inherited by child classes
+        if isinstance(rayarray, ryt.RayBundle):
+            # The whole beam is handled at once
+            return self.propagate_bundle(rayarray)
+        
         for ray in rayarray:
             self.propagate_ray(ray)
             
         return rayarray
     
-    def rms(self, rays):
+    def rms(self, rays, gradient = False):
         # Inherited by child classes
+        # gradient = True also returns the derivatives of the RMS, for a 
+        # RayBundle that has been tracking derivatives
+        if isinstance(rays, ryt.RayBundle):
+            # Positions at the element are recorded during propagation
+            # Only rays that actually hit the element are included
+            ids, points = rays.hits(self)
+            
+            r2 = (points[:, 0] ** 2) + (points[:, 1] ** 2)
+            
+            # Summed in double precision, even for a single precision bundle
+            rms = sp.sqrt(sp.sum(r2, dtype = float) / len(ids))
+            
+            if gradient:
+                # Derivatives with respect to the bundle's tracked parameters
+                dpoints = rays.hitderivatives(self)
+                dr2 = 2 * ((points[:, 0] * dpoints[:, :, 0]) + \
+                           (points[:, 1] * dpoints[:, :, 1]))
+                
+                return rms, sp.sum(dr2, axis = 1) / (2 * len(ids) * rms)
+            
+            return rms
+        
+        # As for a RayBundle, the mean is over the rays that reach the
+        # element, not every ray sent
         total = 0
+        hits = 0
         for ray in rays:
             
             points = ray.vertices()
             
             for point in points:
-                # Interested in positions only at the element's location
-                if point[2] == self.__z0: 
+                # Interested in positions only at the element's location,
+                # allowing for rounding in the final z
+                if abs(point[2] - self.__z0) < 1e-9: 
                     
                     r2 = (point[0] ** 2) + (point[1] ** 2)
                     
                     total += r2
+                    hits += 1
                     
-        meansquare = total / len(rays)
+        meansquare = sp.float64(total) / hits # nan if no ray hits
         
         rms = sp.sqrt(meansquare)
         
@@ -95,6 +536,15 @@ class SphericalRefraction(OpticalElement):
     
     def getcurve(self):
         return self.__curve
+    
+    def getn1(self):
+        return self.__n1
+    
+    def getn2(self):
+        return self.__n2
+    
+    def getaperture(self):
+        return self.__aprad
         
     def intercept(self, ray):
         
@@ -259,6 +709,106 @@ class SphericalRefraction(OpticalElement):
         return newRay
     
     
+    def intercept_bundle(self, bundle):
+        # Batch version of intercept for a RayBundle
+        # Returns an intersection point for every ray, along with a mask 
+        # that is False where a ray misses the lens
+        dtype = bundle.getdtype().type # Parameters take the bundle's precision
+        
+        return sphereIntercept(bundle.getp(), bundle.getk(), \
+                               dtype(self.__z0), dtype(self.__curve), \
+                               self.__aprad)
+    
+    
+    def getnormal_bundle(self, points):
+        # Batch version of getnormal - one normal per row of points
+        dtype = points.dtype.type
+        
+        return sphereNormal(points, dtype(self.__z0), dtype(self.__curve))
+    
+    
+    def refract_bundle(self, khat, nhat):
+        # Batch version of refract for unit directions and normals
+        # Returns new directions and a mask that is False where total 
+        # internal reflection is observed
+        return snellRefract(khat, nhat, \
+                            khat.dtype.type(self.__n1 / self.__n2))
+    
+    
+    def derivatives_bundle(self, bundle, intersection, khat, nhat, \
+                           ids = slice(None)):
+        # Forward-mode derivatives of the intersection points and refracted
+        # directions, with respect to the bundle's tracked parameters
+        # ids selects the rays that intersection etc. belong to
+        # The surface is F = c|x - z0|^2 - 2(z - z0) = 0, whose gradient
+        # 2N = 2(cx, cy, c(z - z0) - 1) is twice the unit normal nhat
+        P = bundle.getp()[ids]
+        K = bundle.getk()[ids]
+        dP = bundle.getdp()[:, ids]
+        dK = bundle.getdk()[:, ids]
+        
+        dc = bundle.seed(self, 'curvature')[:, sp.newaxis]
+        dz0 = bundle.seed(self, 'z0')[:, sp.newaxis]
+        dn1 = bundle.seed(self, 'n1')[:, sp.newaxis]
+        dn2 = bundle.seed(self, 'n2')[:, sp.newaxis]
+        
+        # Distance along each ray to the surface
+        lam = sp.einsum('ij,ij->i', intersection - P, K) / \
+              sp.einsum('ij,ij->i', K, K)
+        
+        local = intersection - [0, 0, self.__z0] # Relative to the vertex
+        
+        # Implicit differentiation of F(p + lam k) = 0 gives dlam
+        moved = dP + (lam[:, sp.newaxis] * dK)
+        dFdc = sp.einsum('ij,ij->i', local, local) / 2
+        dFdz0 = -1 * nhat[:, 2]
+        dlam = -1 * (sp.einsum('pij,ij->pi', moved, nhat) + \
+                     (dFdc * dc) + (dFdz0 * dz0)) / \
+               sp.einsum('ij,ij->i', K, nhat)
+        
+        dX = moved + (K * dlam[:, :, sp.newaxis])
+        
+        # Derivative of the unit normal N
+        dN = (self.__curve * dX) + (local * dc[:, :, sp.newaxis])
+        dN[:, :, 2] -= self.__curve * dz0
+        
+        # Derivative of the normalised incoming direction
+        length = sp.sqrt(sp.einsum('ij,ij->i', K, K))[:, sp.newaxis]
+        dkhat = (dK - (khat * sp.einsum('pij,ij->pi', dK, khat)\
+                       [:, :, sp.newaxis])) / length
+        
+        # Derivative of Snell's law, as used in refract_bundle
+        ratio = self.__n1 / self.__n2
+        dratio = (dn1 / self.__n2) - ((self.__n1 * dn2) / (self.__n2 ** 2))
+        
+        cosine = sp.einsum('ij,ij->i', khat, nhat)
+        dcosine = sp.einsum('pij,ij->pi', dkhat, nhat) + \
+                  sp.einsum('ij,pij->pi', khat, dN)
+        
+        sine2 = 1 - (cosine ** 2)
+        alongnormal = sp.sqrt(1 - ((ratio ** 2) * sine2))
+        dalongnormal = ((ratio * cosine * dcosine) - (sine2 * dratio)) * \
+                       ratio / alongnormal
+        
+        dK2 = (dratio[:, :, sp.newaxis] * \
+               (khat - (nhat * cosine[:, sp.newaxis]))) + \
+              (ratio * (dkhat - (dN * cosine[:, sp.newaxis]) - \
+                        (nhat * dcosine[:, :, sp.newaxis]))) - \
+              (dN * alongnormal[:, sp.newaxis]) - \
+              (nhat * dalongnormal[:, :, sp.newaxis])
+        
+        return dX, dK2
+    
+    
+    def propagate_bundle(self, bundle):
+        # Batch version of propagate_ray - acts on every ray in the bundle
+        dtype = bundle.getdtype().type
+        
+        return propagateSurface(bundle, self, dtype(self.__z0), \
+                                dtype(self.__curve), \
+                                dtype(self.__n1 / self.__n2), self.__aprad)
+    
+    
     def plotlensyz(self, rayarray): # Plots lens in figures
         yfine = sp.linspace(-1 * self.__aprad, self.__aprad, 101)
         
@@ -287,6 +837,9 @@ class OutputPlane(OpticalElement):
         
     def __repr__(self):
         return "OutputPlane({0})".format(self.__z0)
+    
+    def getz(self):
+        return self.__z0
         
     def intercept(self, ray):
         # Same as curvature == 0 case above
@@ -320,15 +873,27 @@ class OutputPlane(OpticalElement):
         
         return endRay
     
+    def intercept_bundle(self, bundle):
+        # Batch version of intercept for a RayBundle
+        return planeIntercept(bundle.getp(), bundle.getk(), \
+                              bundle.getdtype().type(self.__z0))
+    
+    def propagate_bundle(self, bundle):
+        # Batch version of propagate_ray
+        return propagatePlane(bundle, self, bundle.getdtype().type(self.__z0))
+    
     def plotlensyz(self, rayarray):
         # Plots output plane in figures
         # Extent given by most displaced ray
-        rayposfinal = []
-        
-        for ray in rayarray:
-            rayposfinal.append(ray.getp())
+        if isinstance(rayarray, ryt.RayBundle):
+            aprad = sp.nanmax(rayarray.getp()[:, 1])
+        else:
+            rayposfinal = []
+            for ray in rayarray:
+                rayposfinal.append(ray.getp())
+                
+            aprad = max(row[1] for row in rayposfinal)
             
-        aprad = max(row[1] for row in rayposfinal)
         yfine = sp.linspace(-1 * aprad, aprad, 101)
         z = sp.full(len(yfine), self.__z0)
         
@@ -12,7 +12,10 @@ relating to this optimisation
 
 import System as sy
 
+import multiprocessing as mp
+
 import scipy as sp
+import scipy.optimize as spo
 import matplotlib.pyplot as plt
 
 
@@ -50,13 +53,60 @@ def lenslist(focallength, lensn, d):
 
 def spherAb(lenses):
     # lenses is a list of lenses CONTAINING THE OUTPUT PLANE
-    beam = sy.createCylBeam(20, 0.2) # Beam passed through test lenses
+    beam = sy.createCylBeam(20, 0.2, asbundle = True, history = False)
+    # Beam passed through test lenses - only the final positions are needed
     sy.propagateSystem(lenses, beam)
     aberration = lenses[-1].rms(beam)
     # Gives RMS at output plane for each test lens
     return aberration
 
 
+def spherAbGradient(lenses, parameters):
+    # As spherAb, but also returns the derivatives of the RMS with respect
+    # to parameters, a list of (lens, name) pairs such as (lens, 'curvature')
+    beam = sy.createCylBeam(20, 0.2, asbundle = True, history = False)
+    beam.differentiate(parameters)
+    sy.propagateSystem(lenses, beam)
+    
+    return lenses[-1].rms(beam, gradient = True)
+
+
+def spherAbStack(candidates):
+    # As spherAb for every candidate list of lenses, with every candidate 
+    # traced together in one stack (see System.SystemStack)
+    # Candidates must all have the same number of surfaces
+    beam = sy.createCylBeam(20, 0.2, asbundle = True, history = False)
+    
+    return list(sy.stackSystems(candidates).rms(beam))
+
+
+def adjustor3Gradient(c1, focallength, lensn, d):
+    # Derivative of the c2 given by adjustor3 with respect to c1
+    top = (1 / (focallength * (lensn - 1))) - c1
+    bottom = ((((lensn - 1) * d) / lensn) * c1 ) - 1
+    
+    return ((-1 * bottom) - (top * (((lensn - 1) * d) / lensn))) / \
+           (bottom ** 2)
+
+
+def aberrationList(candidates, workers = 1):
+    # Finds spherAb for every candidate list of lenses
+    # With workers > 1 the candidates are shared out over several processes,
+    # otherwise they are traced together by spherAbStack if they all have
+    # the same surfaces (see System.stackable), or one at a time if not
+    if workers == 1:
+        if sy.stackable(candidates):
+            return spherAbStack(candidates)
+        
+        return [spherAb(lenses) for lenses in candidates]
+    
+    with mp.Pool(workers) as pool:
+        # map returns results in the same order as the candidates
+        aberrations = pool.map(spherAb, candidates)
+        
+    return aberrations
+
+
 def selectBest(aberrations):
     # Finds index of best lens faces
     lowestAb = min(aberrations)
@@ -66,43 +116,129 @@ def selectBest(aberrations):
     return bestIndex
 
 
-def optimum(focallength, lensn, d):
+def optimum(focallength, lensn, d, workers = 1, quiet = False):
     # Returns the best lens configuration
     # focallength is from the edge of the lens
+    # workers sets how many processes evaluate the candidates
+    # quiet = True stops the index of the best candidate being printed
     lenslist1, lenslist2 = lenslist(focallength, lensn, d)
     output = sy.createOutput(focallength + (d/2))
     
-    aberrations = []
+    candidates = []
     
     for x in range(len(lenslist1)):
-        lenses = [lenslist1[x], lenslist2[x], output]
-        aberrations.append(spherAb(lenses))
+        candidates.append([lenslist1[x], lenslist2[x], output])
+        
+    aberrations = aberrationList(candidates, workers)
         
     bestIndex = selectBest(aberrations)
-    print (bestIndex)
+    if not quiet:
+        print (bestIndex)
     
     return lenslist1[bestIndex], lenslist2[bestIndex]
 
 
+def continuousOptimum(focallength, lensn, d, bounds = (0.01, 0.15), \
+                      method = 'bounded', tolerance = 1e-5, quiet = False):
+    # Returns the best lens configuration, without a fixed grid of curvatures
+    # c1 is varied continuously (adjustor3 then sets c2) to minimise RMS
+    # method is 'bounded' (Brent's method within bounds), 'Nelder-Mead', or
+    # 'L-BFGS-B', which uses the analytic gradient of the RMS
+    # quiet = True stops the number of traces being printed
+    output = sy.createOutput(focallength + (d/2))
+    
+    evaluations = [0] # Counts the number of traces carried out
+    
+    def aberration(c1):
+        evaluations[0] += 1
+        try:
+            lens1 = sy.createLens(0, c1, 1, lensn, 5)
+            lens2 = adjustor3(lens1, focallength, lensn, d)
+        except Exception:
+            return sp.inf # Curvature too great for the 5mm aperture
+        
+        return spherAb([lens1, lens2, output])
+    
+    if method == 'bounded':
+        result = spo.minimize_scalar(aberration, bounds = bounds, \
+                                     method = 'bounded', \
+                                     options = {'xatol': tolerance})
+        bestcurve = result.x
+        
+    elif method == 'Nelder-Mead':
+        start = [(bounds[0] + bounds[1]) / 2]
+        result = spo.minimize(lambda c: aberration(c[0]), start, \
+                              method = 'Nelder-Mead', \
+                              options = {'xatol': tolerance})
+        bestcurve = result.x[0]
+        
+    elif method == 'L-BFGS-B':
+        
+        def aberrationGradient(c):
+            evaluations[0] += 1
+            try:
+                lens1 = sy.createLens(0, c[0], 1, lensn, 5)
+                lens2 = adjustor3(lens1, focallength, lensn, d)
+            except Exception:
+                # No slope to follow - the line search steps back instead
+                return sp.inf, sp.zeros(1)
+            
+            rms, grad = spherAbGradient([lens1, lens2, output], \
+                                        [(lens1, 'curvature'), \
+                                         (lens2, 'curvature')])
+            # c2 follows c1 through adjustor3
+            slope = adjustor3Gradient(c[0], focallength, lensn, d)
+            
+            return rms, sp.array([grad[0] + (grad[1] * slope)])
+        
+        start = [(bounds[0] + bounds[1]) / 2]
+        
+        # Starts from a lens that can be made, moving towards the lower bound
+        while not sp.isfinite(aberrationGradient(start)[0]) and \
+              start[0] - bounds[0] > tolerance:
+            start = [(bounds[0] + start[0]) / 2]
+            
+        result = spo.minimize(aberrationGradient, start, jac = True, \
+                              method = 'L-BFGS-B', bounds = [bounds], \
+                              options = {'gtol': tolerance})
+        bestcurve = result.x[0]
+        
+    else:
+        print ()
+        print ('Unknown method: {0}'.format(method))
+        print ()
+        raise Exception
+        
+    if not quiet:
+        print (evaluations[0])
+    
+    lens1 = sy.createLens(0, bestcurve, 1, lensn, 5)
+    
+    return lens1, adjustor3(lens1, focallength, lensn, d), evaluations[0]
+
+
 if __name__ == "__main__":
     focal = 35.487
     d = 10
     
-    optimum(focal, n, d)
+    optimum(focal, n, d, mp.cpu_count())
+    
+    # Finer optimum from far fewer traces than the grid above
+    continuousOptimum(focal, n, d)
     
     lens1, lens2 = lenslist(focal, n, d)
     output = sy.createOutput(40.487)
     
     lens1curves = []
     lens2curves = []
-    aberrations = []
+    candidates = []
     
     for x in range(len(lens1)):
-        lenses = [lens1[x], lens2[x], output]
+        candidates.append([lens1[x], lens2[x], output])
         lens1curves.append(lens1[x].getcurve())
         lens2curves.append(lens2[x].getcurve())
         
-        aberrations.append(spherAb(lenses))
+    aberrations = aberrationList(candidates, mp.cpu_count())
     
     # Graphs lens 1 curvatures only -----------------
     
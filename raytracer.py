@@ -7,8 +7,17 @@ Created on Tue Feb 18 15:24:43 2020
 A module that handles all ray properties and behaviours
 """
 
+import json
+import os
+
 import scipy as sp
 
+# Reasons for a ray in a RayBundle to be terminated
+PROPAGATING = 0 # Not terminated
+MISSED = 1 # Did not meet an element, eg. passed outside its aperture
+REFLECTED = 2 # Total internal reflection
+ABSORBED = 3 # Reached an output plane
+
 class Ray:
     
     """
@@ -66,3 +75,388 @@ class Ray:
         self.append(newp, [0,0,0])  
         
         return self
+
+
+class RayBundle:
+    
+    """
+    A class for a beam of many rays handled together
+    Positions and directions of every ray are held as (N,3) arrays, so an
+    optical element can act on the whole beam in a few array operations
+    instead of one Ray object at a time
+    Past positions are kept in one preallocated (N, surfaces + 1, 3) array,
+    or only the current position is kept if history is False
+    dtype = sp.float32 halves the memory used, for large, coarse traces
+    Each optical element met records which rays hit it and where, so
+    results at an element can be read without searching every vertex
+    Derivatives of positions and directions with respect to chosen element
+    parameters can also be carried along (see differentiate)
+    Warning: Attributes are hidden, and accessing them outside this class
+    should not be attempted
+    """
+    
+    
+    def __init__(self, positions, directions, surfaces = 0, history = True, \
+                 dtype = float):
+        
+        # Arrays are not copied - the bundle never writes into them, so 
+        # read-only (eg. cached) beam arrays can be shared between bundles
+        self.__p = sp.asarray(positions, dtype = dtype).reshape(-1, 3)
+        self.__k = sp.asarray(directions, dtype = dtype).reshape(-1, 3)
+        
+        if len(self.__p) != len(self.__k):
+            print ()
+            print ('Every ray needs both a position and a direction')
+            print ()
+            raise Exception
+        
+        # False once a ray has been terminated
+        self.__alive = sp.ones(len(self.__p), dtype = bool)
+        self.__live = None # Ids of the live rays, found when first needed
+        self.__reasons = sp.full(len(self.__p), PROPAGATING, dtype = sp.int8)
+        
+        self.__history = history
+        
+        # Running record of past positions, filled in column by column
+        self.__allp = None
+        self.__count = 1 # Number of vertices recorded so far
+        
+        if history:
+            self.__allp = sp.empty((len(self.__p), surfaces + 1, 3), \
+                                   dtype = self.__p.dtype)
+            self.__allp[:, 0] = self.__p
+        
+        # Maps each optical element to the ids and positions of its hits
+        self.__hits = {}
+        
+        # Derivatives are only tracked once differentiate is called
+        self.__params = []
+        self.__dp = None
+        self.__dk = None
+        self.__hitdp = {}
+        
+    def __len__(self):
+        return len(self.__p)
+        
+    def __repr__(self):
+        return "RayBundle({0} rays)".format(len(self))
+    
+    def __str__(self):
+        return "A bundle of {0} rays, {1} still propagating".format( \
+                                  len(self), sp.count_nonzero(self.__alive))
+        
+    def getp(self):
+        return self.__p
+    
+    def getk(self):
+        return self.__k
+    
+    def getdtype(self):
+        return self.__p.dtype
+    
+    def getalive(self):
+        return self.__alive
+    
+    def getlive(self):
+        # Ids of the rays still propagating, in order
+        # Only worked out again after rays have been stopped
+        if self.__live is None:
+            self.__live = sp.flatnonzero(self.__alive)
+            
+        return self.__live
+    
+    def getreasons(self):
+        # Why each ray was terminated - PROPAGATING, MISSED, REFLECTED or 
+        # ABSORBED
+        return self.__reasons
+    
+    def copy(self):
+        # A new bundle in the same state, which can be propagated separately
+        # Arrays that are never changed in place are shared, not copied
+        new = RayBundle.__new__(RayBundle)
+        new.__dict__.update(self.__dict__)
+        
+        if self.__history:
+            new.__allp = self.__allp[:, :self.__count].copy()
+        
+        new.__hits = dict(self.__hits)
+        new.__hitdp = dict(self.__hitdp)
+        new.__params = list(self.__params)
+        
+        return new
+    
+    def chunk(self, start, stop):
+        # A new bundle of rays start to stop of this one, in the same state,
+        # to be propagated separately and put back with join
+        # Hit records are not carried over
+        new = RayBundle.__new__(RayBundle)
+        new.__dict__.update(self.__dict__)
+        
+        new.__p = self.__p[start:stop]
+        new.__k = self.__k[start:stop]
+        new.__alive = self.__alive[start:stop]
+        new.__reasons = self.__reasons[start:stop]
+        new.__live = None
+        
+        if self.__history:
+            new.__allp = self.__allp[start:stop, :self.__count].copy()
+            
+        if self.__dp is not None:
+            new.__dp = self.__dp[:, start:stop]
+            new.__dk = self.__dk[:, start:stop]
+        
+        new.__hits = {}
+        new.__hitdp = {}
+        new.__params = list(self.__params)
+        
+        return new
+    
+    def join(self, parts):
+        # Takes on the state of parts, chunks of this bundle in order (see 
+        # chunk) which have all been propagated through the same elements
+        # Hit records of the parts are added to this bundle's, with ids 
+        # counted from the start of this bundle
+        self.__p = sp.concatenate([part.__p for part in parts])
+        self.__k = sp.concatenate([part.__k for part in parts])
+        self.__alive = sp.concatenate([part.__alive for part in parts])
+        self.__reasons = sp.concatenate([part.__reasons for part in parts])
+        self.__live = None
+        self.__count = parts[0].__count
+        
+        if self.__history:
+            self.__allp = sp.concatenate([part.__allp[:, :self.__count] \
+                                          for part in parts])
+        
+        if self.__dp is not None:
+            self.__dp = sp.concatenate([part.__dp for part in parts], 1)
+            self.__dk = sp.concatenate([part.__dk for part in parts], 1)
+            
+        if not self.__history:
+            self.__hits.clear() # Only the latest element is remembered
+            self.__hitdp.clear()
+        
+        starts = sp.cumsum([0] + [len(part) for part in parts])
+        
+        for element in parts[0].__hits:
+            ids = [part.__hits[element][0] + start for part, start in \
+                   zip(parts, starts)]
+            points = [part.__hits[element][1] for part in parts]
+            self.__hits[element] = (sp.concatenate(ids), \
+                                    sp.concatenate(points))
+            
+            if element in parts[0].__hitdp:
+                dpoints = [part.__hitdp[element] for part in parts]
+                self.__hitdp[element] = sp.concatenate(dpoints, 1)
+            
+        return self
+    
+    def getdp(self):
+        # Derivatives of positions, shape (parameters, N, 3), or None
+        return self.__dp
+    
+    def getdk(self):
+        # Derivatives of directions, shape (parameters, N, 3), or None
+        return self.__dk
+    
+    def differentiate(self, parameters):
+        # Starts tracking derivatives with respect to parameters, a list of 
+        # (element, name) pairs - name is 'z0', 'curvature', 'n1' or 'n2'
+        self.__params = list(parameters)
+        
+        self.__dp = sp.zeros((len(self.__params), len(self), 3))
+        self.__dk = sp.zeros((len(self.__params), len(self), 3))
+        
+        return self
+    
+    def seed(self, element, name):
+        # Derivative of each tracked parameter with respect to the given 
+        # parameter of element - 1 where they are the same, 0 otherwise
+        seed = sp.zeros(len(self.__params))
+        
+        for index, (paramelement, paramname) in enumerate(self.__params):
+            if paramelement is element and paramname == name:
+                seed[index] = 1
+                
+        return seed
+    
+    def reserve(self, surfaces):
+        # Makes room in the record for at least this many more vertices
+        if not self.__history:
+            return self
+        
+        needed = self.__count + surfaces
+        
+        if needed > self.__allp.shape[1]:
+            allp = sp.empty((len(self), needed, 3), dtype = self.__p.dtype)
+            allp[:, :self.__count] = self.__allp[:, :self.__count]
+            self.__allp = allp
+            
+        return self
+    
+    def append(self, newp, newk = None, newdp = None, newdk = None):
+        # newp and newk hold a row for every ray, including terminated ones
+        # newdp and newdk are their derivatives, if these are being tracked
+        if newk is None:
+            newk = self.__k # The default direction is the current direction
+        
+        if self.__dp is not None:
+            self.__dp = newdp
+            self.__dk = self.__dk if newdk is None else newdk
+        
+        if self.__history:
+            if self.__count == self.__allp.shape[1]:
+                # Grows the record if too few surfaces were reserved
+                self.reserve(max(self.__count, 1))
+            self.__allp[:, self.__count] = newp
+        
+        self.__count += 1
+        
+        self.__p = newp
+        self.__k = newk
+        
+        return self
+    
+    def vertices(self):
+        # Array of shape (N, number of vertices, 3) - one path per ray
+        # Without history, only the current position of each ray is given
+        if not self.__history:
+            return self.__p[:, sp.newaxis]
+        
+        return self.__allp[:, :self.__count]
+    
+    def record(self, element, ids):
+        # Called by an element once the rays given by ids have hit it
+        # Their current positions are copied into one contiguous array
+        if not self.__history:
+            self.__hits.clear() # Only the latest element is remembered
+        
+        self.__hits[element] = (ids, self.__p[ids])
+        
+        if self.__dp is not None:
+            if not self.__history:
+                self.__hitdp.clear()
+            self.__hitdp[element] = self.__dp[:, ids]
+        
+        return self
+    
+    def hits(self, element):
+        # Returns the ids of the rays that hit element, and where they hit
+        if element not in self.__hits:
+            print ()
+            print ('No hits recorded for {0}'.format(element))
+            print ()
+            raise Exception
+        
+        return self.__hits[element]
+    
+    def save(self, directory, elements):
+        # Writes the bundle to directory as .npy files, which can be read
+        # back without loading them into memory (see load)
+        # Hits are saved for each of elements, by their place in the list
+        # Derivatives are not saved
+        os.makedirs(directory, exist_ok = True)
+        
+        def path(name):
+            return os.path.join(directory, name + '.npy')
+        
+        sp.save(path('positions'), self.__p)
+        sp.save(path('directions'), self.__k)
+        sp.save(path('reasons'), self.__reasons)
+        
+        if self.__history:
+            sp.save(path('vertices'), self.vertices())
+        
+        hit = []
+        for index, element in enumerate(elements):
+            if element in self.__hits:
+                ids, points = self.__hits[element]
+                sp.save(path('hitids{0}'.format(index)), ids)
+                sp.save(path('hitpoints{0}'.format(index)), points)
+                hit.append(index)
+        
+        with open(os.path.join(directory, 'bundle.json'), 'w') as file:
+            json.dump({'history': self.__history, 'hits': hit}, file)
+            
+        return self
+    
+    @classmethod
+    def load(cls, directory, elements, mmap_mode = 'r'):
+        # Reads a bundle written by save, with hits recorded against 
+        # elements, given in the same order as when it was saved
+        # Arrays are memory-mapped (mmap_mode as for scipy.load), so only 
+        # the parts that are used are read from disk - None reads them all
+        def array(name):
+            return sp.load(os.path.join(directory, name + '.npy'), \
+                           mmap_mode = mmap_mode)
+        
+        with open(os.path.join(directory, 'bundle.json')) as file:
+            info = json.load(file)
+        
+        new = cls.__new__(cls)
+        
+        new.__p = array('positions')
+        new.__k = array('directions')
+        new.__reasons = array('reasons')
+        new.__alive = new.__reasons == PROPAGATING
+        new.__live = None
+        
+        new.__history = info['history']
+        new.__allp = array('vertices') if new.__history else None
+        new.__count = new.__allp.shape[1] if new.__history else 1
+        
+        new.__hits = {}
+        for index in info['hits']:
+            ids = array('hitids{0}'.format(index))
+            points = array('hitpoints{0}'.format(index))
+            new.__hits[elements[index]] = (ids, points)
+            
+        new.__params = []
+        new.__dp = None
+        new.__dk = None
+        new.__hitdp = {}
+        
+        return new
+    
+    def relabel(self, old, new):
+        # Moves the hit records of element old over to element new
+        # Used when a copy of this bundle is reused for an identical element
+        if old in self.__hits:
+            self.__hits[new] = self.__hits.pop(old)
+            
+        if old in self.__hitdp:
+            self.__hitdp[new] = self.__hitdp.pop(old)
+            
+        return self
+    
+    def hitderivatives(self, element):
+        # Derivatives of the hit positions at element, one row per parameter
+        self.hits(element) # Checks the element was met
+        
+        return self.__hitdp[element]
+    
+    def stop(self, mask, reason):
+        # Terminates the rays selected by mask, making them 'stationary'
+        # Unlike Ray.terminate, no new vertex is added here
+        mask = mask & self.__alive
+        
+        if not mask.any():
+            return self # Nothing to stop, so nothing needs copying
+        
+        newreasons = self.__reasons.copy()
+        newreasons[mask] = reason
+        self.__reasons = newreasons
+        
+        newk = self.__k.copy()
+        newk[mask] = 0
+        
+        self.__k = newk
+        
+        if self.__dk is not None:
+            newdk = self.__dk.copy()
+            newdk[:, mask] = 0
+            self.__dk = newdk
+            
+        self.__alive = self.__alive & ~mask
+        self.__live = None
+        
+        return self
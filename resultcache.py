@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+A module that keeps the results of tracing whole systems on disk
+
+A result is found from the lenses (by their repr), the beam generator and
+its parameters, and the version of the tracing code, so tracing the same
+system with the same beam again, even from another script or session, is
+only a lookup. The least recently used results are removed once the cache
+grows past its size limit.
+
+"""
+
+import raytracer as ryt
+import opticalequipment as oe
+import System as sy
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import scipy as sp
+
+
+def codeVersion():
+    # Hash of the source of the tracing modules - results traced by other
+    # versions of the code are never used
+    digest = hashlib.sha256()
+
+    for module in [ryt, oe, sy]:
+        with open(module.__file__, 'rb') as file:
+            digest.update(file.read())
+
+    return digest.hexdigest()
+
+
+def traceKey(lenses, generator, parameters, dtype, version):
+    # Stable hash of everything that decides the result of a trace
+    description = json.dumps([version, [repr(lens) for lens in lenses],
+                              generator.__name__, list(parameters),
+                              sp.dtype(dtype).str], default = float)
+
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def directorySize(directory):
+    # Total size in bytes of the files in directory
+    total = 0
+
+    for root, folders, files in os.walk(directory):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+
+    return total
+
+
+class ResultCache:
+
+    """
+    A directory of trace results, each kept in a folder named by its key
+    Each result holds the RMS at the last lens, the counts of rays, hits
+    and termination reasons, the spot histogram, and optionally the whole
+    traced bundle (see System.saveTrace)
+    maxsize is the most bytes kept before the least recently used results
+    are deleted
+    Warning: Attributes should not be accessed directly outside of this class
+    """
+
+    def __init__(self, directory, maxsize = 10**9, bins = 100):
+        self.__directory = directory
+        self.__maxsize = maxsize
+        self.__bins = bins
+        self.__version = codeVersion()
+
+        self.__found = 0 # Lookups answered from the cache
+        self.__traced = 0 # Lookups that needed a trace
+
+        os.makedirs(directory, exist_ok = True)
+
+    def __repr__(self):
+        return "ResultCache({0!r}, {1}, {2})".format(self.__directory,
+                                                     self.__maxsize,
+                                                     self.__bins)
+
+    def __len__(self):
+        return len(self.entries())
+
+    def getcounts(self):
+        # Number of lookups answered from the cache, and number traced
+        return self.__found, self.__traced
+
+    def entries(self):
+        # Folders of the results held, least recently used first
+        folders = [os.path.join(self.__directory, name) for name in
+                   os.listdir(self.__directory) if not name.startswith('.')]
+
+        return sorted(folders, key = os.path.getmtime)
+
+    def trace(self, lenses, generator, *parameters, keepbundle = False,
+              dtype = float):
+        # Result of tracing the beam generator(*parameters) (eg. with
+        # System.createCylBeam) through lenses, as a dictionary with keys
+        # 'rms', 'rays', 'hits', 'reasons', 'histogram' (a SpotHistogram)
+        # and 'bundle' (a memory-mapped RayBundle if keepbundle, else None)
+        if isinstance(lenses, sy.OpticalSystem):
+            lenses = lenses.getlenses()
+
+        key = traceKey(lenses, generator, parameters, dtype, self.__version)
+        folder = os.path.join(self.__directory, key)
+
+        if os.path.exists(os.path.join(folder, 'result.json')) and \
+           (os.path.exists(os.path.join(folder, 'trace')) or not keepbundle):
+            self.__found += 1
+            os.utime(folder) # Marks it as recently used
+            return self.read(folder, lenses, keepbundle)
+
+        self.__traced += 1
+
+        beam = generator(*parameters, asbundle = True, history = keepbundle,
+                         dtype = dtype)
+        sy.propagateSystem(lenses, beam)
+
+        statistics = sy.BeamStatistics(self.__bins).add(beam, lenses[-1])
+        self.write(folder, statistics, beam if keepbundle else None, lenses)
+        self.evict()
+
+        return self.read(folder, lenses, keepbundle)
+
+    def write(self, folder, statistics, bundle, lenses):
+        # Stores a result, writing it to a temporary folder first so that a
+        # result is never seen half written
+        temporary = tempfile.mkdtemp(dir = self.__directory, prefix = '.')
+
+        rays, hits, reasons = statistics.getcounts()
+        grid, extent = statistics.gethistogram().getgrid()
+
+        with open(os.path.join(temporary, 'result.json'), 'w') as file:
+            json.dump({'rms': statistics.getrms(), 'rays': rays,
+                       'hits': hits, 'reasons': reasons.tolist(),
+                       'extent': extent}, file, default = float)
+
+        sp.save(os.path.join(temporary, 'histogram.npy'), grid)
+
+        if bundle is not None:
+            sy.saveTrace(os.path.join(temporary, 'trace'), bundle, lenses)
+
+        shutil.rmtree(folder, ignore_errors = True)
+        os.rename(temporary, folder)
+
+        return folder
+
+    def read(self, folder, lenses, keepbundle):
+        # Reads back a result stored by write
+        with open(os.path.join(folder, 'result.json')) as file:
+            result = json.load(file)
+
+        grid = sp.load(os.path.join(folder, 'histogram.npy'))
+        result['histogram'] = sy.SpotHistogram(result.pop('extent'),
+                                               len(grid)).addcounts(grid)
+        result['reasons'] = sp.array(result['reasons'])
+
+        result['bundle'] = None
+        if keepbundle:
+            # Hits are put back against the lenses given, not new ones
+            trace = os.path.join(folder, 'trace')
+            result['bundle'] = ryt.RayBundle.load(trace, lenses)
+
+        return result
+
+    def evict(self):
+        # Deletes the least recently used results until the cache is no
+        # bigger than maxsize - the most recent result is always kept
+        entries = self.entries()
+        sizes = [directorySize(folder) for folder in entries]
+        total = sum(sizes)
+
+        for folder, size in zip(entries[:-1], sizes[:-1]):
+            if total <= self.__maxsize:
+                break
+
+            shutil.rmtree(folder, ignore_errors = True)
+            total -= size
+
+        return self
+
+    def clear(self):
+        # Deletes every result
+        for folder in self.entries():
+            shutil.rmtree(folder, ignore_errors = True)
+
+        return self
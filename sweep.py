@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+A module that runs large sweeps over singlet lens designs
+
+Every point of a grid of (c1, thickness, index, focal length) is scored by
+the RMS spot size at the output plane, as in optimiser.spherAb. Points are
+shared out in shards over a work queue, and each finished shard is
+appended to a results store on disk, so that a sweep which is stopped
+carries on from where it got to when it is run again.
+
+Run as __main__, eg.
+    python sweep.py --store sweep.jsonl --workers 8
+
+"""
+
+import optimiser as op
+import System as sy
+
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+
+import scipy as sp
+
+
+FIELDS = ['c1', 'thickness', 'index', 'focallength']
+
+
+def parameterGrid(curves, thicknesses, indices, focallengths):
+    # Every combination of the values given, as (c1, thickness, index,
+    # focal length) tuples of floats
+    return [tuple(float(value) for value in point) for point in \
+            itertools.product(curves, thicknesses, indices, focallengths)]
+
+
+def designAberration(c1, thickness, index, focallength):
+    # RMS at the output plane for the singlet with first face curvature c1,
+    # with the second face set by optimiser.adjustor3, as in optimum
+    # Every point uses the same small beam, which each worker builds once
+    # and keeps in System's beam cache (see System.clearBeamCache)
+    try:
+        lens1 = sy.createLens(0, c1, 1, index, 5)
+        lens2 = op.adjustor3(lens1, focallength, index, thickness)
+    except Exception:
+        return sp.inf # Curvature too great for the 5mm aperture
+
+    output = sy.createOutput(focallength + (thickness / 2))
+
+    return float(op.spherAb([lens1, lens2, output]))
+
+
+def evaluateShard(points):
+    # Scores every point of a shard - returns a list of (point, rms)
+    return [(point, designAberration(*point)) for point in points]
+
+
+def shardPoints(points, shardsize):
+    # Splits points into lists of at most shardsize points
+    return [points[start:start + shardsize] for start in \
+            range(0, len(points), shardsize)]
+
+
+class WorkQueue:
+
+    """
+    Parent class for the queues a sweep is run on
+    A queue runs a function over work items, and yields the results as
+    items are finished, in any order - a queue spread over several
+    machines can be used by making a child class with its own run
+    """
+
+    def run(self, function, items):
+        raise NotImplementedError()
+
+
+class SerialQueue(WorkQueue):
+
+    """
+    Runs every item in this process, one after the other
+    A stand-in for other queues, eg. for testing
+    """
+
+    def __repr__(self):
+        return "SerialQueue()"
+
+    def run(self, function, items):
+        for item in items:
+            yield function(item)
+
+
+class ProcessQueue(WorkQueue):
+
+    """
+    Runs items on a pool of worker processes on this machine
+    function must be picklable, ie. defined at the top level of a module
+    Warning: Attributes should not be accessed directly outside of this class
+    """
+
+    def __init__(self, workers = None):
+        self.__workers = mp.cpu_count() if workers is None else workers
+
+    def __repr__(self):
+        return "ProcessQueue({0})".format(self.__workers)
+
+    def run(self, function, items):
+        with mp.Pool(self.__workers) as pool:
+            # Results come back as soon as each item is done
+            for result in pool.imap_unordered(function, items):
+                yield result
+
+
+class ResultStore:
+
+    """
+    An append-only file of sweep results, one JSON line per point
+    Lines are only ever added, and each shard is flushed to disk as it is
+    written - a line cut short by the job being stopped is ignored when
+    the store is read back
+    Warning: Attributes should not be accessed directly outside of this class
+    """
+
+    def __init__(self, path):
+        self.__path = path
+
+    def __repr__(self):
+        return "ResultStore({0!r})".format(self.__path)
+
+    def getpath(self):
+        return self.__path
+
+    def load(self):
+        # Returns a dictionary of point -> rms for every complete line
+        results = {}
+
+        if not os.path.exists(self.__path):
+            return results
+
+        with open(self.__path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                    point = tuple(float(record[field]) for field in FIELDS)
+                    results[point] = float(record['rms'])
+                except (ValueError, KeyError):
+                    continue # Unfinished line
+
+        return results
+
+    def append(self, results):
+        # Adds (point, rms) results to the end of the store
+        lines = []
+        for point, rms in results:
+            record = dict(zip(FIELDS, point))
+            record['rms'] = rms
+            lines.append(json.dumps(record) + '\n')
+
+        if os.path.exists(self.__path) and os.path.getsize(self.__path) > 0:
+            with open(self.__path, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    # An unfinished line is left on its own
+                    lines.insert(0, '\n')
+
+        with open(self.__path, 'a') as file:
+            file.write(''.join(lines))
+            file.flush()
+            os.fsync(file.fileno())
+
+        return self
+
+
+def runSweep(points, store, queue = None, shardsize = 64):
+    # Scores every point not already in store, appending results as each
+    # shard is finished - returns a dictionary of point -> rms for points
+    # queue is a WorkQueue, by default a ProcessQueue on every core
+    if queue is None:
+        queue = ProcessQueue()
+
+    done = store.load()
+    remaining = [point for point in points if point not in done]
+
+    print ('{0} of {1} points already done'.format(len(points) - \
+                                                   len(remaining), \
+                                                   len(points)))
+
+    for results in queue.run(evaluateShard, shardPoints(remaining, \
+                                                        shardsize)):
+        store.append(results)
+        done.update(results)
+
+    return {point: done[point] for point in points}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[1])
+    parser.add_argument('--store', default = 'sweep.jsonl',
+                        help = 'file the results are appended to')
+    parser.add_argument('--workers', type = int, default = mp.cpu_count())
+    parser.add_argument('--shardsize', type = int, default = 64)
+    args = parser.parse_args()
+
+    grid = parameterGrid(sp.arange(0.01, 0.151, 0.005), [5, 7.5, 10], \
+                         [1.5168, 1.6, 1.7], [35.487, 50, 100])
+
+    results = runSweep(grid, ResultStore(args.store), \
+                       ProcessQueue(args.workers), args.shardsize)
+
+    best = min(results, key = results.get)
+    print (dict(zip(FIELDS, best)), results[best])
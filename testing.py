@@ -12,7 +12,12 @@ import raytracer as ryt
 import opticalequipment as oe
 import System as sy
 import optimiser as op
+import sweep as sw
+import resultcache as rc
+import tolerance as tl
 
+import os
+import tempfile
 
 import scipy as sp
 
@@ -292,3 +297,481 @@ sy.plotyz(rays, [testlens2, outputlens2, output], 'C1 = 0.06')
 
 
 
+
+
+#%% Tests of RayBundle and batch propagation
+
+# A bundle should follow exactly the same paths as the equivalent Ray objects
+
+lenses = [sy.createLens(0, 0.03, 1, 1.5168, 33), sy.createOutput(97.835)]
+
+rays = sy.createCylBeam(5, 0.2)
+bundle = sy.createCylBeam(5, 0.2, asbundle = True)
+print (bundle)
+
+sy.propagateSystem(lenses, rays)
+sy.propagateSystem(lenses, bundle)
+print (bundle)
+
+# Expect both RMS values to agree closely - both are over the rays that
+# reach the plane
+print (lenses[-1].rms(rays))
+print (lenses[-1].rms(bundle))
+
+# Expect a difference close to zero
+print (sp.amax(abs(bundle.getp() - [ray.getp() for ray in rays])))
+
+# A ray that misses the lens stops at the plane of the lens
+missbundle = ryt.RayBundle([[0,0,-20], [0,0,-20]], [[0,0.1,1], [1,1,1]])
+testsphere = oe.SphericalRefraction(0, 0.03, 1, 1.5, 33)
+testsphere.propagate_bundle(missbundle)
+print (missbundle.getalive()) # Expect [True, False]
+print (missbundle.vertices())
+
+
+#%% Tests of hit records kept by a RayBundle
+
+testsphere = sy.createLens(0, 0.03, 1, 1.5, 5)
+output = sy.createOutput(60)
+
+# Wide enough that the outer rings miss the 5mm aperture
+bundle = sy.createCylBeam(40, 0.2, asbundle = True)
+sy.propagateSystem([testsphere, output], bundle)
+
+ids, points = bundle.hits(testsphere)
+print (len(bundle), len(ids)) # Fewer hits than rays
+
+# Hits on a curved surface are not all at z0, but are still included
+print (points[-1])
+
+# RMS at the output is taken over the rays that reached it
+print (output.rms(bundle))
+
+
+#%% Tests of RMS derivatives against finite differences
+
+def rmsAtOutput(c1, gradient = False):
+    lens1 = sy.createLens(0, c1, 1, 1.5168, 5)
+    lens2 = sy.createLens(10, -0.02, 1.5168, 1, 5)
+    output = sy.createOutput(40)
+    
+    bundle = sy.createCylBeam(10, 0.3, asbundle = True)
+    if gradient:
+        bundle.differentiate([(lens1, 'curvature'), (lens2, 'z0'), \
+                              (output, 'z0')])
+    sy.propagateSystem([lens1, lens2, output], bundle)
+    
+    return output.rms(bundle, gradient)
+
+value, grad = rmsAtOutput(0.03, True)
+print (grad)
+
+# Expect the first derivative to agree with this to several figures
+print ((rmsAtOutput(0.03 + 1e-6) - rmsAtOutput(0.03 - 1e-6)) / 2e-6)
+
+
+#%% Tests of evaluating optimiser candidates on several processes
+
+lenslist1, lenslist2 = op.lenslist(35.487, 1.5168, 10)
+output = sy.createOutput(35.487 + (10 / 2))
+
+candidates = []
+for x in range(len(lenslist1)):
+    candidates.append([lenslist1[x], lenslist2[x], output])
+
+serial = op.aberrationList(candidates)
+parallel = op.aberrationList(candidates, workers = 2)
+
+# Expect a difference close to zero
+print (sp.amax(abs(sp.array(serial) - sp.array(parallel))))
+
+# Expect the same best lens from one process and from two
+print (op.optimum(35.487, 1.5168, 10, quiet = True)[0])
+print (op.optimum(35.487, 1.5168, 10, workers = 2, quiet = True)[0])
+
+
+#%% Tests of the continuous optimiser against the grid of curvatures
+
+output = sy.createOutput(35.487 + (10 / 2))
+
+gridlens1, gridlens2 = op.optimum(35.487, 1.5168, 10, quiet = True)
+print ('grid', gridlens1.getcurve(), op.spherAb([gridlens1, gridlens2, \
+                                                 output]))
+
+# Expect every method to find about the same c1, with an RMS no greater
+# than that of the grid's best lens, from far fewer traces
+for method in ['bounded', 'Nelder-Mead', 'L-BFGS-B']:
+    lens1, lens2, evaluations = op.continuousOptimum(35.487, 1.5168, 10, \
+                                                     method = method, \
+                                                     quiet = True)
+    print (method, lens1.getcurve(), op.spherAb([lens1, lens2, output]), \
+           evaluations)
+
+# Curvatures above about 0.15 are too great for the 5mm aperture - expect
+# the same optimum from every method when the bounds include them
+for method in ['bounded', 'Nelder-Mead', 'L-BFGS-B']:
+    lens1, lens2, evaluations = op.continuousOptimum(35.487, 1.5168, 10, \
+                                                     bounds = (0.01, 0.3), \
+                                                     method = method, \
+                                                     quiet = True)
+    print (method, lens1.getcurve(), op.spherAb([lens1, lens2, output]), \
+           evaluations)
+
+
+#%% Tests of the beam cache
+
+sy.clearBeamCache()
+
+first = sy.createCylBeam(20, 0.2, asbundle = True)
+second = sy.createCylBeam(20, 0.2, asbundle = True)
+
+# Expect True - both bundles start from the same cached arrays
+print (sp.shares_memory(first.getp(), second.getp()))
+print (len(sy.beamcache), sy.cachedBytes())
+
+try:
+    first.getp()[0, 0] = 1
+except ValueError:
+    print ('Cached beam arrays cannot be written to')
+
+# Expect a single precision beam to have arrays of its own
+single = sy.createCylBeam(20, 0.2, asbundle = True, dtype = sp.float32)
+print (single.getdtype(), len(sy.beamcache))
+
+# Expect a beam bigger than beamcachebytes not to be kept
+large = sy.createCylBeam(600, 0.0125, asbundle = True, history = False)
+print (len(large), len(sy.beamcache))
+del large
+
+# Expect nothing left in the cache, and a new beam with arrays of its own
+sy.clearBeamCache()
+print (len(sy.beamcache), sy.cachedBytes())
+
+third = sy.createCylBeam(20, 0.2, asbundle = True)
+print (sp.shares_memory(first.getp(), third.getp()))
+
+
+#%% Tests of the RMS of several beam widths from one trace
+
+# The outer rings miss the 5mm aperture
+lenses = [sy.createLens(0, 0.03, 1, 1.5168, 5), \
+          sy.createLens(10, 0, 1.5168, 1, 5), sy.createOutput(67.895)]
+
+byrings = sy.rmsByRings(lenses, 30, 0.2)
+
+# Expect each beam traced on its own to give the same RMS as rmsByRings
+for number in [1, 5, 10, 20, 30]:
+    beam = sy.createCylBeam(number, 0.2, asbundle = True, history = False)
+    sy.propagateSystem(lenses, beam)
+    print (number, byrings[number - 1], lenses[-1].rms(beam))
+
+
+#%% Tests of TraceCache when only the output plane moves
+
+lenses = [sy.createLens(0, 0.03, 1, 1.5168, 33.3), \
+          sy.createLens(10, -0.03, 1.5168, 1, 33.3)]
+
+cache = sy.TraceCache(sy.createCylBeam(10, 0.2, asbundle = True, \
+                                       history = False))
+
+for z in [38, 40, 42]:
+    output = sy.createOutput(z)
+    # Only the output plane is traced after the first system
+    print (output.rms(cache.propagate(lenses + [output])))
+    
+# Expect the same RMS as the first of the values above
+bundle = sy.createCylBeam(10, 0.2, asbundle = True)
+output = sy.createOutput(38)
+sy.propagateSystem(lenses + [output], bundle)
+print (output.rms(bundle))
+
+
+#%% Tests of the focus finders
+
+convexleft = sy.createLens(0, 0.03, 1, 1.5168, 33.3)
+planeright = sy.createLens(10, 0, 1.5168, 1, 33.3)
+
+# Paraxial estimates - expect about 97.83 and 67.91, as found by hand
+print (sy.paraxialFocus([convexleft]))
+print (sy.paraxialFocus([convexleft, planeright]))
+
+# Best focus of a wide beam is nearer the lens due to spherical aberration
+beam = sy.createCylBeam(20, 0.2, asbundle = True, history = False)
+print (sy.findFocus([convexleft, planeright], beam))
+
+# Expect a larger RMS than found above, as this plane is out of focus
+output = sy.createOutput(67.895)
+beam = sy.createCylBeam(20, 0.2, asbundle = True)
+sy.propagateSystem([convexleft, planeright, output], beam)
+print (output.rms(beam))
+
+
+#%% Tests of the batched intercept for nearly flat and missed surfaces
+
+rays = ryt.RayBundle([[0, 1, -20], [0, 1, -20], [0, 0, -20]], \
+                     [[0, 0, 1], [0, 0.1, 1], [0, 1, 0]])
+
+# Expect [0, 1, ~5e-10], [0, 3, ~4.5e-9] and a miss for the parallel ray
+nearlyflat = oe.SphericalRefraction(0, 1e-9, 1, 1.5, 33)
+print (nearlyflat.intercept_bundle(rays))
+
+# A curvature of exactly 0 gives the same points, with z = 0
+flat = oe.SphericalRefraction(0, 0, 1, 1.5, 33)
+print (flat.intercept_bundle(rays))
+
+# Expect the second ray to miss this small, strongly curved surface
+smallsphere = oe.SphericalRefraction(10, 0.5, 1, 1.5, 2)
+print (smallsphere.intercept_bundle(rays)[1])
+
+
+#%% Tests of single precision tracing against double precision
+
+convexleft = sy.createLens(0, 0.03, 1, 1.5168, 33.3)
+planeright = sy.createLens(10, 0, 1.5168, 1, 33.3)
+lenses = [convexleft, planeright, sy.createOutput(67.895)]
+
+results = []
+for dtype in [sp.float64, sp.float32]:
+    beam = sy.createCylBeam(20, 0.2, asbundle = True, dtype = dtype)
+    sy.propagateSystem(lenses, beam)
+    print (beam.getdtype())
+    results.append(lenses[-1].rms(beam))
+    
+# Expect a relative difference of about 2e-5 (see README)
+print (results, abs(results[1] - results[0]) / results[0])
+
+
+#%% Tests of streaming a beam through a system in chunks
+
+lenses = [sy.createLens(0, 0.03, 1, 1.5168, 5), \
+          sy.createLens(10, 0, 1.5168, 1, 5), sy.createOutput(67.895)]
+
+# The outer rings miss the 5mm aperture
+statistics = sy.streamSystem(lenses, sy.cylBeamChunks(1000, 60, 0.1))
+
+beam = sy.createCylBeam(60, 0.1, asbundle = True)
+sy.propagateSystem(lenses, beam)
+
+# Expect the same RMS, and the same counts of missed and absorbed rays
+print (statistics.getrms(), lenses[-1].rms(beam))
+print (statistics.getcounts())
+print (sp.bincount(beam.getreasons()))
+
+# The first chunk only holds the inner rings, but expect every hit to be
+# counted in the histogram
+print (statistics.gethistogram().getgrid()[0].sum(), \
+       statistics.getcounts()[1])
+
+
+#%% Tests of the spot histogram
+
+histogram = sy.SpotHistogram([[-1, 1], [-1, 1]], 4)
+
+# Expect one count in each corner bin, and the point at x = 5 to be ignored
+histogram.add(sp.array([[-0.9, -0.9], [0.9, 0.9], [-0.9, 0.9], \
+                        [0.9, -0.9], [5, 0]]))
+print (histogram.getgrid())
+
+# Without an extent, it grows to fit every hit added
+histogram = sy.SpotHistogram(bins = 8)
+histogram.add(sp.array([[0.1, 0.1]]))
+histogram.add(sp.array([[3, -3]]))
+print (histogram.getgrid()[0].sum(), histogram.getgrid()[1])
+
+# Plotting time does not depend on the number of rays
+beam = sy.createCylBeam(100, 0.05, asbundle = True)
+lens = sy.createLens(0, 0.03, 1, 1.5168, 33)
+output = sy.createOutput(97.835)
+sy.propagateSystem([lens, output], beam)
+sy.plotspotxy(beam, 'Spot histogram at the output plane', \
+              element = output, bins = 200)
+
+
+#%% Tests of drawing a sample of the rays
+
+beam = sy.createCylBeam(60, 0.1, asbundle = True)
+lens = sy.createLens(0, 0.03, 1, 1.5168, 33)
+output = sy.createOutput(97.835)
+sy.propagateSystem([lens, output], beam)
+
+# Expect about 500 rays, with all 60 rings represented
+rings = sy.cylBeamRings(60, 0.1)
+chosen = sy.sampleRays(len(beam), 500, rings)
+print (len(chosen), len(sp.unique(rings[chosen])))
+sy.plotyz(beam, [lens, output], 'Sampled rays', maxrays = 500, \
+          groups = rings)
+
+
+#%% Tests of the OpticalSystem class
+
+lenses = [sy.createLens(0, 0.03, 1, 1.5168, 5), \
+          sy.createLens(10, 0, 1.5168, 1, 5), sy.createOutput(67.895)]
+system = sy.OpticalSystem(lenses)
+print (system)
+
+# Expect the same hits as propagating through the list of lenses
+beam = sy.createCylBeam(30, 0.2, asbundle = True)
+sy.propagateSystem(system, beam)
+listbeam = sy.createCylBeam(30, 0.2, asbundle = True)
+sy.propagateSystem(lenses, listbeam)
+print (lenses[-1].rms(beam), lenses[-1].rms(listbeam))
+print (sp.array_equal(beam.vertices(), listbeam.vertices()))
+
+# Expect an exception, as the refractive index is not continuous
+try:
+    sy.OpticalSystem([sy.createLens(0, 0.03, 1, 1.5168, 5), \
+                      sy.createLens(10, 0, 1.4, 1, 5)])
+except Exception:
+    print ('Mismatched indices rejected')
+
+
+#%% Tests of tracing only the live rays
+
+# Most of the beam misses the first 5mm aperture, so after it only the live
+# rays are worked on - expect the same results as when every ray is
+lenses = [sy.createLens(0, 0.03, 1, 1.5168, 5), \
+          sy.createLens(10, 0, 1.5168, 1, 5), sy.createOutput(67.895)]
+
+beam = sy.createCylBeam(60, 0.2, asbundle = True)
+sy.propagateSystem(lenses[:1], beam)
+print (len(beam), len(beam.getlive())) # Rays in the beam, rays still live
+sy.propagateSystem(lenses[1:], beam)
+
+oe.COMPACTFRACTION = 0 # Never picks out the live rays
+everyray = sy.createCylBeam(60, 0.2, asbundle = True)
+sy.propagateSystem(lenses, everyray)
+oe.COMPACTFRACTION = 0.9
+
+print (sp.array_equal(beam.vertices(), everyray.vertices()))
+print (lenses[-1].rms(beam), lenses[-1].rms(everyray))
+
+
+#%% Tests of the numba backend
+
+# Only runs if numba is installed
+if oe.numba is not None:
+    lenses = [sy.createLens(0, 0.03, 1, 1.5168, 5), \
+              sy.createLens(10, 0, 1.5168, 1, 5), sy.createOutput(67.895)]
+    
+    beam = sy.createCylBeam(40, 0.2, asbundle = True)
+    sy.OpticalSystem(lenses, 'numpy').trace(beam)
+    compiledbeam = sy.createCylBeam(40, 0.2, asbundle = True)
+    sy.OpticalSystem(lenses, 'numba').trace(compiledbeam)
+    
+    # Expect the same RMS and reasons, and paths equal to rounding error
+    print (lenses[-1].rms(beam), lenses[-1].rms(compiledbeam))
+    print (sp.array_equal(beam.getreasons(), compiledbeam.getreasons()))
+    print (sp.allclose(beam.vertices(), compiledbeam.vertices()))
+
+
+#%% Tests of tracing a bundle on several threads
+
+lenses = [sy.createLens(0, 0.03, 1, 1.5168, 5), \
+          sy.createLens(10, 0, 1.5168, 1, 5), sy.createOutput(67.895)]
+
+beam = sy.createCylBeam(40, 0.2, asbundle = True)
+sy.propagateSystem(lenses, beam)
+
+# Chunks of 1000 rays on 4 threads - expect the same paths, hits and RMS
+threaded = sy.createCylBeam(40, 0.2, asbundle = True)
+sy.propagateSystem(lenses, threaded, threads = 4, chunksize = 1000)
+
+print (sp.array_equal(beam.vertices(), threaded.vertices()))
+print (sp.array_equal(beam.hits(lenses[0])[0], threaded.hits(lenses[0])[0]))
+print (lenses[-1].rms(beam), lenses[-1].rms(threaded))
+
+
+#%% Tests of a resumable sweep
+
+store = sw.ResultStore(os.path.join(tempfile.mkdtemp(), 'sweep.jsonl'))
+grid = sw.parameterGrid([0.01, 0.02, 0.03], [5, 10], [1.5168], [35.487])
+
+# Only the first half is run, as if the sweep had been stopped
+sw.runSweep(grid[:3], store, sw.SerialQueue(), shardsize = 2)
+
+# Expect 3 of the 6 points to be done already, and only the rest traced
+results = sw.runSweep(grid, store, sw.SerialQueue(), shardsize = 2)
+
+# Expect the same RMS as optimiser.spherAb gives
+lens1 = sy.createLens(0, 0.01, 1, 1.5168, 5)
+lens2 = op.adjustor3(lens1, 35.487, 1.5168, 5)
+print (results[grid[0]], op.spherAb([lens1, lens2, sy.createOutput(37.987)]))
+
+
+#%% Tests of saving and loading a trace
+
+lenses = [sy.createLens(0, 0.03, 1, 1.5168, 5), \
+          sy.createLens(10, 0, 1.5168, 1, 5), sy.createOutput(67.895)]
+beam = sy.createCylBeam(40, 0.2, asbundle = True)
+sy.propagateSystem(lenses, beam)
+
+directory = sy.saveTrace(os.path.join(tempfile.mkdtemp(), 'trace'), beam, \
+                         lenses)
+
+# The loaded arrays are memory-mapped, and hits are recorded against the
+# new lenses - expect the same RMS, paths and reasons
+loaded, loadedlenses = sy.loadTrace(directory)
+print (loadedlenses)
+print (type(loaded.vertices()))
+print (lenses[-1].rms(beam), loadedlenses[-1].rms(loaded))
+print (sp.array_equal(beam.vertices(), loaded.vertices()))
+print (sp.array_equal(beam.getreasons(), loaded.getreasons()))
+sy.plotyz(loaded, loadedlenses, 'Loaded trace', maxrays = 500)
+
+
+#%% Tests of the on-disk result cache
+
+cache = rc.ResultCache(tempfile.mkdtemp())
+lenses = [sy.createLens(0, 0.03, 1, 1.5168, 5), \
+          sy.createLens(10, 0, 1.5168, 1, 5), sy.createOutput(67.895)]
+
+first = cache.trace(lenses, sy.createCylBeam, 40, 0.2)
+# New lenses with the same parameters - expect the result to be found
+same = [sy.createLens(0, 0.03, 1, 1.5168, 5), \
+        sy.createLens(10, 0, 1.5168, 1, 5), sy.createOutput(67.895)]
+again = cache.trace(same, sy.createCylBeam, 40, 0.2)
+
+print (first['rms'], again['rms'])
+print (cache.getcounts()) # Expect 1 found, 1 traced
+
+# The whole bundle can also be kept, and is read back memory-mapped
+kept = cache.trace(lenses, sy.createCylBeam, 40, 0.2, keepbundle = True)
+print (kept['bundle'], lenses[-1].rms(kept['bundle']))
+
+
+#%% Tests of Monte Carlo tolerance analysis
+
+lens1 = sy.createLens(0, 0.02, 1, 1.5168, 5)
+lens2 = op.adjustor3(lens1, 35.487, 1.5168, 10)
+lenses = [lens1, lens2, sy.createOutput(40.487)]
+
+# With no errors, every sample should have the nominal RMS
+percentiles, rms = tl.toleranceAnalysis(lenses, samples = 20)
+print (percentiles, op.spherAb(lenses))
+
+# 2000 perturbed systems, traced as one stack
+percentiles, rms = tl.toleranceAnalysis(lenses, samples = 2000, \
+                                        curvature = 5e-4, z0 = 0.05, \
+                                        n2 = 1e-3, decentre = 0.02, seed = 1)
+print (percentiles) # 50th, 90th, 95th and 99th percentiles
+print (tl.estimateYield(rms, 0.2)) # Fraction with an RMS of 0.2mm or less
+
+
+#%% Tests of tracing a stack of systems at once
+
+# 15 biconvex lenses, differing only in their curvatures
+curves1 = sp.arange(0.01, 0.151, 0.01)
+curves2 = sp.array([op.adjustor3(sy.createLens(0, c1, 1, 1.5168, 5), \
+                                 35.487, 1.5168, 10).getcurve() \
+                    for c1 in curves1])
+
+stack = sy.SystemStack([0, 10], [curves1, curves2], [1, 1.5168], \
+                       [1.5168, 1], [5, 5], 40.487)
+print (stack)
+
+beam = sy.createCylBeam(20, 0.2, asbundle = True, history = False)
+stacked = stack.rms(beam)
+
+# Expect the same RMS as tracing each system on its own
+print (max(abs(stacked[index] - op.spherAb(stack.lenses(index))) \
+           for index in range(len(stack))))
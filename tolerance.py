@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+A module for Monte Carlo tolerance analysis of a lens system
+
+Many copies of a system are made with random errors in the curvature, z0,
+refractive index and decentre of each surface. All of them are traced
+together, as one stack of rays (see System.SystemStack), and the spread of
+their RMS spot sizes at the output plane gives the yield of a design.
+
+"""
+
+import System as sy
+
+import scipy as sp
+
+
+def perturbedSystems(lenses, samples, curvature = 0, z0 = 0, n2 = 0, \
+                     decentre = 0, seed = None):
+    # Makes samples copies of lenses (refracting surfaces followed by an
+    # output plane) with normally distributed errors in each surface,
+    # whose standard deviations are given (curvature in 1/mm, z0 and
+    # decentre in mm, decentre being applied in both x and y)
+    # The index after a surface only changes if it is not 1 (air), and the
+    # n1 of the next surface follows it
+    # Returns a System.SystemStack of the copies
+    rng = sp.random.default_rng(seed)
+
+    nominal = sy.stackSystems([lenses])
+    shape = (samples, nominal.getz().shape[1])
+
+    z0s = nominal.getz() + rng.normal(0, z0, shape)
+    curves = nominal.getcurve() + rng.normal(0, curvature, shape)
+    n1s = sp.tile(nominal.getn1(), (samples, 1))
+    n2s = sp.tile(nominal.getn2(), (samples, 1))
+
+    glass = nominal.getn2()[0] != 1
+    n2s[:, glass] += rng.normal(0, n2, (samples, sp.count_nonzero(glass)))
+    n1s[:, 1:] = n2s[:, :-1]
+
+    decentres = rng.normal(0, decentre, shape + (2,))
+
+    return sy.SystemStack(z0s.T, curves.T, n1s.T, n2s.T, \
+                          nominal.getaperture()[0], \
+                          nominal.getoutput()[0], \
+                          decentres.transpose(1, 0, 2))
+
+
+def toleranceAnalysis(lenses, samples = 1000, curvature = 0, z0 = 0, \
+                      n2 = 0, decentre = 0, number = 20, resolution = 0.2, \
+                      percentiles = (50, 90, 95, 99), seed = None):
+    # RMS at the output plane of samples perturbed copies of lenses (see
+    # perturbedSystems), traced with a createCylBeam beam of number rings
+    # Returns the RMS at each of percentiles, and the RMS of every sample
+    # The beam arrays stay in System's beam cache if they are small enough
+    # (see System.cachedArrays) - System.clearBeamCache frees them
+    systems = perturbedSystems(lenses, samples, curvature, z0, n2, \
+                               decentre, seed)
+
+    beam = sy.createCylBeam(number, resolution, asbundle = True, \
+                            history = False)
+
+    rms = systems.rms(beam)
+
+    # Samples that no rays got through have an RMS of nan
+    return sp.nanpercentile(rms, percentiles), rms
+
+
+def estimateYield(rms, limit):
+    # Fraction of samples whose RMS is no more than limit
+    return sp.count_nonzero(rms <= limit) / len(rms)